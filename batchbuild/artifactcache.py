@@ -0,0 +1,164 @@
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+from batchbuilderror import BatchBuildError
+from installmanifest import install_from_stage
+
+# Dir of the artifact cache, inside DEVO_BUILD_BASE_DIR. Snapshots contain
+# absolute paths inside the prefix of the devo, so the cache cannot be shared
+# between devos
+CACHE_DIR_NAME = ".artifact-cache"
+
+INDEX_NAME = "index.json"
+
+DEFAULT_MAX_SIZE = "10G"
+
+SIZE_RX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)\s*$", re.IGNORECASE)
+
+SIZE_UNITS = ["", "K", "M", "G", "T"]
+
+
+def parse_size(text, option_name):
+    """
+    Converts a size like "500M" or "10G", read from option option_name, to a
+    number of bytes
+    """
+    match = SIZE_RX.match(str(text))
+    if not match:
+        raise BatchBuildError("Invalid %s: %s" % (option_name, text))
+    value, unit = match.groups()
+    return int(float(value) * 1024 ** SIZE_UNITS.index(unit.upper()))
+
+
+def format_size(size):
+    for unit in SIZE_UNITS:
+        if size < 1024 or unit == SIZE_UNITS[-1]:
+            break
+        size /= 1024.
+    return "%.1f %sB" % (size, unit) if unit else "%d B" % size
+
+
+class ArtifactCache(object):
+    """
+    Stores snapshots of the files installed by modules, as tarballs named
+    after the fingerprint of the module state. The fingerprint covers the
+    module revision, its config and the fingerprints of its upstream modules,
+    so if a module is built again in a state it has already been built in, its
+    snapshot can be installed instead.
+
+    The least recently used snapshots are removed when the cache grows over
+    its maximum size.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._index_name = os.path.join(cache_dir, INDEX_NAME)
+        self._lock = threading.Lock()
+        self._index = {"entries": {}, "hits": 0, "misses": 0}
+        if os.path.exists(self._index_name):
+            try:
+                with open(self._index_name) as fp:
+                    self._index = json.load(fp)
+            except ValueError:
+                pass
+
+    def restore(self, key, manifest):
+        """
+        Install the snapshot stored for key, updating manifest. Returns a
+        tuple (changed, unchanged, removed) with file counts, or None if there
+        is no snapshot for key.
+        """
+        path = self._get_path(key)
+        with self._lock:
+            entry = self._index["entries"].get(key)
+            if entry is None or not os.path.exists(path):
+                self._index["misses"] += 1
+                self._save()
+                return None
+            entry["last-used"] = time.time()
+            self._index["hits"] += 1
+            self._save()
+
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        try:
+            with tarfile.open(path) as tar:
+                tar.extractall(tmp_dir)
+            return install_from_stage(tmp_dir, manifest)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def store(self, key, module_name, manifest, max_size):
+        """
+        Store a snapshot of the files listed in manifest for key, then remove
+        the least recently used snapshots until the cache is smaller than
+        max_size bytes
+        """
+        path = self._get_path(key)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_name = path + ".tmp"
+        # Favor speed over size: snapshots are mostly binaries
+        with tarfile.open(tmp_name, "w:gz", compresslevel=1) as tar:
+            for file_name in sorted(manifest.files):
+                if os.path.lexists(file_name):
+                    tar.add(file_name, recursive=False)
+        os.rename(tmp_name, path)
+
+        with self._lock:
+            self._index["entries"][key] = {
+                "module": module_name,
+                "size": os.path.getsize(path),
+                "last-used": time.time(),
+            }
+            self._evict(max_size, key)
+            self._save()
+
+    def get_stats(self):
+        """
+        Returns a dict with the snapshot count, the total size, the hit and
+        miss counts, and a dict of module name => (count, size)
+        """
+        with self._lock:
+            modules = {}
+            for entry in self._index["entries"].values():
+                count, size = modules.get(entry["module"], (0, 0))
+                modules[entry["module"]] = (count + 1, size + entry["size"])
+            return {
+                "count": len(self._index["entries"]),
+                "size": self._get_total_size(),
+                "hits": self._index["hits"],
+                "misses": self._index["misses"],
+                "modules": modules,
+            }
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".tar.gz")
+
+    def _get_total_size(self):
+        return sum(x["size"] for x in self._index["entries"].values())
+
+    def _evict(self, max_size, keep_key):
+        entries = self._index["entries"]
+        lru_keys = sorted(entries, key=lambda x: entries[x]["last-used"])
+        for key in lru_keys:
+            if self._get_total_size() <= max_size:
+                break
+            if key == keep_key:
+                continue
+            path = self._get_path(key)
+            if os.path.exists(path):
+                os.unlink(path)
+            del entries[key]
+
+    def _save(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_name = self._index_name + ".tmp"
+        with open(tmp_name, "w") as fp:
+            json.dump(self._index, fp, indent=2, sort_keys=True)
+        os.rename(tmp_name, self._index_name)
@@ -1,2 +1,11 @@
 class BatchBuildError(Exception):
     pass
+
+
+class StepTimeoutError(BatchBuildError):
+    """
+    Raised when a command runs for too long, or stops producing output
+    """
+    def __init__(self, msg, step):
+        BatchBuildError.__init__(self, msg)
+        self.step = step
@@ -0,0 +1,705 @@
+"""
+Update and build modules
+"""
+import base64
+import copy
+import multiprocessing
+import os
+import sys
+
+import dashboard
+import flog
+import nanotify
+
+from artifactcache import ArtifactCache, CACHE_DIR_NAME, format_size
+from batchbuilderror import BatchBuildError, StepTimeoutError
+from buildlog import BuildLog, LOG_SUFFIX, get_error_lines, rotate_logs
+from dashboard import Dashboard
+from fetcher import SourceFetcher
+from installmanifest import InstallManifest, install_packed_files, pack_files
+from jobserver import JobServer
+from module import Module, get_step_limits
+from remote import MessageHandler, WorkerPool
+from runner import Runner
+from scheduler import Scheduler, complete_estimates
+from statestore import StateStore, fingerprint_state
+from targetprofile import TargetDb, get_ninja_log_size
+from timingdb import TimingDb, create_run_id, estimate_durations, estimate_step_durations
+from watcher import SourceWatcher
+
+
+class BuildResult(object):
+    def __init__(self):
+        self.vcs_fails = []
+        self.build_fails = []
+        self.cancelled = []
+        self.up_to_date = []
+        self.restored = []
+        # [name, step] of the modules which failed because a step timed out
+        self.timeouts = []
+        # name => (hits, misses)
+        self.compiler_cache_stats = {}
+
+
+# Name of the file the state of modules is written to during a build, in the
+# log dir
+STATUS_FILE_NAME = "status.json"
+
+
+def get_log_file_name(log_dir, name):
+    return os.path.join(log_dir, name.replace("/", "_") + LOG_SUFFIX)
+
+
+def create_artifact_cache():
+    return ArtifactCache(os.path.join(os.environ["DEVO_BUILD_BASE_DIR"], CACHE_DIR_NAME))
+
+
+class BuildContext(object):
+    """
+    Holds what is shared by the builds of all modules
+    """
+    def __init__(self, project, graph, log_dir, options):
+        self.project = project
+        self.run_id = create_run_id()
+        self.log_dir = log_dir
+        self.options = options
+        self.result = BuildResult()
+        self.graph = graph
+        self.state_store = StateStore(os.environ["DEVO_BUILD_BASE_DIR"])
+        self.artifact_cache = create_artifact_cache()
+        self.timing_db = TimingDb(log_dir)
+        self.target_db = TargetDb(log_dir) if options.profile else None
+        # Read the options of the modules before building, so that invalid
+        # values stop the build before it starts
+        self.step_limits = {}
+        for name in self.graph.names:
+            config = self.graph.config_for_name[name]
+            try:
+                Module(config)
+                self.step_limits[name] = get_step_limits(config)
+            except BatchBuildError, exc:
+                raise BatchBuildError("%s: %s" % (name, exc))
+        self.jobserver = None
+        self.fetcher = None
+        self.dashboard = None
+        self.workers = None
+        # Set of modules with upstream changes, None if not checked
+        self.outdated = None
+        # name => BuildLog
+        self._logs = {}
+        # Modules whose previous logs have been rotated during this run
+        self._rotated = set()
+
+    def get_log_file_name(self, name):
+        return get_log_file_name(self.log_dir, name)
+
+    def open_log(self, name):
+        """
+        Returns the BuildLog of module name. The log stays open until
+        close_log() is called, so that source fetching and building write to
+        the same log. The previous logs are rotated the first time, so that
+        modules which do not run keep their last log.
+        """
+        log = self._logs.get(name)
+        if log is None:
+            log_file_name = self.get_log_file_name(name)
+            if name not in self._rotated:
+                rotate_logs(log_file_name, self.options.log_retention)
+                self._rotated.add(name)
+            log = self._logs[name] = BuildLog(log_file_name)
+        return log
+
+    def close_log(self, name):
+        log = self._logs.pop(name, None)
+        if log:
+            log.close()
+
+    def close_logs(self):
+        for name in self._logs.keys():
+            self.close_log(name)
+
+    def create_runner(self, name, log_file, prefix):
+        record_step = self.timing_db.create_recorder(self.run_id, self.project, name)
+        status = self.dashboard.get_status(name) if self.dashboard else None
+        return Runner(log_file, self.options.verbose, prefix=prefix, record_step=record_step,
+                      status=status, limits=self.step_limits[name])
+
+
+def update_module(ctx, module, runner):
+    """
+    Switch branch and update/checkout the source of module, as requested by
+    options. Returns True on success
+    """
+    options = ctx.options
+    if options.switch_branch and module.has_checkout():
+        module.switch_branch(runner)
+
+    if options.no_src:
+        return True
+    if ctx.outdated is not None and module.name not in ctx.outdated \
+            and not options.switch_branch:
+        runner.report("update", "no upstream changes")
+        return True
+    try:
+        if module.has_checkout():
+            module.update(runner)
+        else:
+            module.checkout(runner)
+    except BatchBuildError, exc:
+        record_vcs_failure(ctx, module.name, exc)
+        return False
+    return True
+
+
+def record_vcs_failure(ctx, name, exc):
+    log_file_name = ctx.get_log_file_name(name)
+    flog.error("%s failed to update/checkout: %s", name, exc)
+    flog.p("See %s", log_file_name)
+    ctx.result.vcs_fails.append([name, str(exc), log_file_name])
+    if isinstance(exc, StepTimeoutError):
+        ctx.result.timeouts.append([name, exc.step])
+    nanotify.notify(name, "Failed to update/checkout", icon="dialog-warning")
+
+
+def record_build_failure(ctx, name, exc):
+    log_file_name = ctx.get_log_file_name(name)
+    flog.error("%s failed to build: %s", name, exc)
+    flog.p("See %s", log_file_name)
+    ctx.result.build_fails.append([name, str(exc), log_file_name])
+    if isinstance(exc, StepTimeoutError):
+        ctx.result.timeouts.append([name, exc.step])
+    nanotify.notify(name, "Failed to build", icon="dialog-error")
+
+
+def fetch_module(ctx, config):
+    """
+    Update/checkout the module described by config, from a SourceFetcher
+    thread. Returns True on success
+    """
+    module = Module(config)
+    runner = ctx.create_runner(module.name, ctx.open_log(module.name), module.name)
+    return update_module(ctx, module, runner)
+
+
+def build_module(ctx, config, prefix=None):
+    """
+    Update and build the module described by config. Returns True on success.
+
+    If ctx has a fetcher, the module source is updated by it: wait for it to
+    be done instead of updating the module here.
+    """
+    name = config.flat_get("name")
+    status = ctx.dashboard.get_status(name)
+    status.start()
+    try:
+        ok = _build_module(ctx, config, prefix)
+    finally:
+        ctx.close_log(name)
+    if not ok:
+        status.finish(dashboard.FAILED)
+    elif name in ctx.result.up_to_date:
+        status.finish(dashboard.UP_TO_DATE)
+    else:
+        status.finish(dashboard.DONE)
+    return ok
+
+
+def _build_module(ctx, config, prefix):
+    if ctx.workers:
+        return _build_module_remotely(ctx, config, prefix)
+    options = ctx.options
+    name = config.flat_get("name")
+    assert name
+    module = Module(config, jobserver=ctx.jobserver)
+
+    # update/checkout
+    if ctx.fetcher:
+        ok = ctx.fetcher.wait(name)
+        runner = ctx.create_runner(name, ctx.open_log(name), prefix)
+    else:
+        runner = ctx.create_runner(name, ctx.open_log(name), prefix)
+        ok = update_module(ctx, module, runner)
+    if not ok and options.fatal:
+        return False
+
+    if options.src_only:
+        return ok
+
+    # Skip build if nothing changed
+    state = ctx.state_store.create_state(module, ctx.graph.upstream[name])
+    if not options.force and not options.refresh_build \
+            and ctx.state_store.is_up_to_date(name, state):
+        flog.p("%s is up to date, not building", name)
+        ctx.result.up_to_date.append(name)
+        return ok
+
+    # Install a snapshot of a previous build done in the same state
+    key = None
+    if module.uses_artifact_cache() and state["revision"] is not None:
+        key = fingerprint_state(state)
+    if key and not options.force and not options.refresh_build:
+        if module.restore_artifacts(runner, ctx.artifact_cache, key):
+            ctx.state_store.set_built(name, state)
+            ctx.result.restored.append(name)
+            return ok
+
+    # Build
+    try:
+        if options.refresh_build:
+            module.refresh_build()
+        module.configure(runner, force=options.reconfigure)
+        ninja_log_size = get_ninja_log_size(module.build_dir) if ctx.target_db else None
+        try:
+            module.build(runner)
+        finally:
+            if ctx.target_db:
+                count = ctx.target_db.add_ninja_targets(ctx.run_id, ctx.project, module,
+                                                        ninja_log_size)
+                if count is None:
+                    runner.report("build", "not profiled, only ninja builds can be profiled")
+                else:
+                    runner.report("build", "profiled %d targets" % count)
+        if options.clean_install:
+            module.uninstall(runner)
+        module.install(runner)
+        if key:
+            module.store_artifacts(runner, ctx.artifact_cache, key)
+        ctx.state_store.set_built(name, state)
+        stats = module.get_compiler_cache_stats()
+        if stats:
+            ctx.result.compiler_cache_stats[name] = stats
+        nanotify.notify(name, "Build successfully", icon="dialog-ok")
+    except BatchBuildError, exc:
+        record_build_failure(ctx, name, exc)
+        return False
+    return ok
+
+
+def get_all_upstream(graph, name):
+    """
+    Returns the set of modules name depends on, directly or not
+    """
+    result = set()
+    todo = list(graph.upstream[name])
+    while todo:
+        upstream = todo.pop()
+        if upstream not in result:
+            result.add(upstream)
+            todo.extend(graph.upstream.get(upstream, []))
+    return result
+
+
+def _build_module_remotely(ctx, config, prefix):
+    try:
+        worker = ctx.workers.acquire()
+    except BatchBuildError, exc:
+        record_build_failure(ctx, config.flat_get("name"), exc)
+        return False
+    try:
+        return _build_module_on_worker(ctx, config, prefix, worker)
+    finally:
+        ctx.workers.release(worker)
+
+
+def _build_module_on_worker(ctx, config, prefix, worker):
+    """
+    Update and build the module described by config on worker, then install
+    the files it returns
+    """
+    options = ctx.options
+    name = config.flat_get("name")
+    module = Module(config)
+    runner = ctx.create_runner(name, ctx.open_log(name), prefix)
+    handler = MessageHandler(name, worker, ctx.open_log(name), ctx.dashboard.get_status(name),
+                             ctx.timing_db.create_recorder(ctx.run_id, ctx.project, name))
+    flat_config = config.flatten()
+
+    # update/checkout
+    ok = True
+    revision = None
+    try:
+        reply = worker.request({"type": "update", "config": flat_config,
+                                "switch-branch": options.switch_branch,
+                                "no-src": options.no_src}, handler)
+        revision = reply["revision"]
+    except BatchBuildError, exc:
+        record_vcs_failure(ctx, name, exc)
+        ok = False
+    if not ok and options.fatal:
+        return False
+
+    if options.src_only:
+        return ok
+
+    # Skip build if nothing changed
+    state = ctx.state_store.create_state_for_revision(revision, config, ctx.graph.upstream[name])
+    if not options.force and not options.refresh_build \
+            and ctx.state_store.is_up_to_date(name, state):
+        flog.p("%s is up to date, not building", name)
+        ctx.result.up_to_date.append(name)
+        return ok
+
+    key = None
+    if module.uses_artifact_cache() and revision is not None:
+        key = fingerprint_state(state)
+    if key and not options.force and not options.refresh_build:
+        if module.restore_artifacts(runner, ctx.artifact_cache, key):
+            ctx.state_store.set_built(name, state)
+            ctx.result.restored.append(name)
+            return ok
+
+    # Build
+    devo_prefix = os.environ["DEVO_PREFIX"]
+    try:
+        # Send the files of the upstream modules the worker does not have, or
+        # has in an older state
+        upstream = []
+        for upstream_name in sorted(get_all_upstream(ctx.graph, name)):
+            fingerprint = ctx.state_store.fingerprint(upstream_name)
+            if upstream_name in worker.modules and worker.modules[upstream_name] == fingerprint:
+                continue
+            manifest = InstallManifest(upstream_name)
+            if manifest.files:
+                files = pack_files(manifest.files, devo_prefix)
+                upstream.append({"name": upstream_name, "files": base64.b64encode(files)})
+            worker.modules[upstream_name] = fingerprint
+
+        reply = worker.request({"type": "build", "config": flat_config, "upstream": upstream,
+                                "refresh-build": options.refresh_build,
+                                "reconfigure": options.reconfigure}, handler)
+        counts = install_packed_files(base64.b64decode(reply["files"]), devo_prefix,
+                                      InstallManifest(name))
+        runner.report("install", "files from %s: %d changed, %d unchanged, %d removed"
+                      % ((worker.name,) + counts))
+        if key:
+            module.store_artifacts(runner, ctx.artifact_cache, key)
+        ctx.state_store.set_built(name, state)
+        worker.modules[name] = ctx.state_store.fingerprint(name)
+        nanotify.notify(name, "Build successfully", icon="dialog-ok")
+    except BatchBuildError, exc:
+        record_build_failure(ctx, name, exc)
+        return False
+    return ok
+
+
+def create_fetcher(ctx):
+    """
+    Returns a started SourceFetcher if sources must be fetched concurrently,
+    None otherwise
+    """
+    options = ctx.options
+    if options.fetch_jobs < 1 or options.no_src or ctx.workers:
+        return None
+
+    def fetch(name):
+        return fetch_module(ctx, ctx.graph.config_for_name[name])
+
+    # Fetch in build order, so that the first built modules are ready first
+    fetcher = SourceFetcher(ctx.graph.order, options.fetch_jobs, fetch)
+    fetcher.start()
+    return fetcher
+
+
+def do_uninstall(graph, log_dir, options):
+    """
+    Remove the files installed by the modules of graph, in reverse build order
+    so that modules are removed before the modules they depend on. The modules
+    are then considered not built.
+    """
+    state_store = StateStore(os.environ["DEVO_BUILD_BASE_DIR"])
+    for name in reversed(graph.order):
+        module = Module(graph.config_for_name[name])
+        flog.h1(module.name)
+        log_file_name = get_log_file_name(log_dir, module.name)
+        rotate_logs(log_file_name, options.log_retention)
+        with BuildLog(log_file_name) as log_file:
+            module.uninstall(Runner(log_file, options.verbose))
+        state_store.forget(module.name)
+    return 0
+
+
+def check_upstream(module_configs, options):
+    """
+    Concurrently check which modules have changes in their remote repository.
+    Returns the set of their names.
+    """
+    config_for_name = dict((x.flat_get("name"), x) for x in module_configs)
+    outdated = set()
+
+    def check(name):
+        if Module(config_for_name[name]).has_upstream_changes():
+            outdated.add(name)
+        return True
+
+    names = [x.flat_get("name") for x in module_configs]
+    fetcher = SourceFetcher(names, options.check_jobs, check)
+    fetcher.start()
+    for name in names:
+        fetcher.wait(name)
+    return outdated
+
+
+def refresh_mirrors(module_configs, log_dir, options):
+    """
+    Create or update, concurrently, the mirrors of the git modules which have
+    a mirror-dir. Returns the list of urls which failed
+    """
+    mirrors_for_url = {}
+    for config in module_configs:
+        module = Module(config)
+        mirrors = getattr(module.vcs, "mirrors", None)
+        if mirrors:
+            mirrors_for_url[module.vcs.url] = mirrors
+    if not mirrors_for_url:
+        flog.error("No module has a mirror-dir")
+        return []
+
+    mirror_log_dir = os.path.join(log_dir, "mirrors")
+    if not os.path.exists(mirror_log_dir):
+        os.makedirs(mirror_log_dir)
+    fails = []
+
+    def refresh(url):
+        mirrors = mirrors_for_url[url]
+        name = os.path.basename(mirrors.get_mirror_path(url))
+        log_file_name = get_log_file_name(mirror_log_dir, name)
+        rotate_logs(log_file_name, options.log_retention)
+        with BuildLog(log_file_name) as log_file:
+            runner = Runner(log_file, options.verbose, prefix=name)
+            try:
+                mirrors.refresh(url, runner)
+            except BatchBuildError, exc:
+                flog.error("Failed to refresh mirror of %s: %s", url, exc)
+                flog.p("See %s", log_file_name)
+                fails.append(url)
+                return False
+        return True
+
+    urls = sorted(mirrors_for_url)
+    fetcher = SourceFetcher(urls, options.mirror_jobs, refresh)
+    fetcher.start()
+    for url in urls:
+        fetcher.wait(url)
+    return fails
+
+
+def create_jobserver(options):
+    """
+    Returns a JobServer if build jobs must be shared between modules, None
+    otherwise
+    """
+    if options.jobs == 1 and options.total_jobs is None:
+        return None
+    total_jobs = options.total_jobs or multiprocessing.cpu_count()
+    return JobServer(total_jobs, max_load=options.max_load, use_fifo=options.jobserver_fifo)
+
+
+def do_build(project, graph, log_dir, options):
+    ctx = BuildContext(project, graph, log_dir, options)
+    if options.workers:
+        # Sources are updated by the workers, and each worker builds one
+        # module at a time
+        ctx.workers = WorkerPool(options.workers.split(","), os.path.abspath(sys.argv[0]))
+        jobs = len(ctx.workers.workers)
+    else:
+        if options.check_upstream and not options.no_src:
+            ctx.outdated = check_upstream(graph.configs, options)
+        ctx.jobserver = create_jobserver(options)
+        jobs = options.jobs
+    ctx.dashboard = create_dashboard(ctx)
+    ctx.dashboard.start()
+    ctx.fetcher = create_fetcher(ctx)
+    try:
+        if jobs > 1:
+            do_parallel_build(ctx, jobs)
+        else:
+            do_serial_build(ctx)
+    finally:
+        if ctx.fetcher:
+            ctx.fetcher.stop()
+        if ctx.jobserver:
+            ctx.jobserver.close()
+        if ctx.workers:
+            ctx.workers.close()
+        # Logs of modules which were fetched but not built
+        ctx.close_logs()
+        for name in ctx.result.cancelled:
+            ctx.dashboard.get_status(name).finish(dashboard.CANCELLED)
+        ctx.dashboard.stop()
+    return ctx.result
+
+
+def get_with_dependents(graph, names):
+    """
+    Returns names and the modules depending on them, directly or not
+    """
+    result = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in result:
+            result.add(name)
+            todo.extend(graph.dependents[name])
+    return result
+
+
+def do_watch(project, graph, log_dir, options):
+    """
+    Build the modules of graph, then rebuild them whenever their source
+    changes, until interrupted
+    """
+    print_summary(do_build(project, graph, log_dir, options), options)
+
+    # Sources are edited locally: do not update them, and rebuild modules even
+    # if their revision did not change
+    watch_options = copy.copy(options)
+    watch_options.no_src = True
+    watch_options.check_upstream = False
+    watch_options.force = True
+
+    watcher = SourceWatcher()
+    try:
+        while True:
+            # Sources checked out by the previous build are watched from now on
+            for config in graph.configs:
+                module = Module(config)
+                if not watcher.is_watched(module.name) and module.has_checkout():
+                    watcher.add(module.name, module.src_dir, excluded_dirs=[module.build_dir])
+            flog.h1("Waiting for changes")
+            changed = watcher.wait()
+            names = get_with_dependents(graph, changed)
+            flog.p("Changed: %s", ", ".join(x for x in graph.names if x in changed))
+            result = do_build(project, graph.subgraph(names), log_dir, watch_options)
+            print_summary(result, watch_options)
+    finally:
+        watcher.close()
+
+
+def create_dashboard(ctx):
+    """
+    Returns a Dashboard which always writes a status file, and only shows
+    the state of modules in the terminal if requested
+    """
+    options = ctx.options
+    use_tty = options.dashboard and sys.stdout.isatty()
+    status_file_name = options.status_file or os.path.join(ctx.log_dir, STATUS_FILE_NAME)
+    step_estimates = estimate_step_durations(ctx.timing_db.read(ctx.project))
+    return Dashboard(ctx.project, ctx.graph.names, step_estimates, use_tty=use_tty,
+                     status_file_name=status_file_name)
+
+
+def do_serial_build(ctx):
+    prefix = None
+    nb_modules = len(ctx.graph.order)
+    for idx, name in enumerate(ctx.graph.order):
+        config = ctx.graph.config_for_name[name]
+        flog.h1("%d/%d %s" % (idx + 1, nb_modules, name))
+        if ctx.fetcher or ctx.dashboard.use_tty:
+            # Fetch threads or the dashboard are printing at the same time
+            prefix = name
+        if not build_module(ctx, config, prefix=prefix) and ctx.options.fatal:
+            return
+
+
+def do_parallel_build(ctx, jobs):
+    """
+    Build modules concurrently, following the dependencies between them
+    """
+    def build(config):
+        name = config.flat_get("name")
+        flog.h2(name)
+        try:
+            return build_module(ctx, config, prefix=name)
+        except Exception, exc:
+            # The scheduler logs the traceback, make sure the failure shows
+            # in the summary and the exit code
+            record_build_failure(ctx, name, exc)
+            ctx.dashboard.get_status(name).finish(dashboard.FAILED)
+            raise
+
+    estimates = estimate_durations(ctx.timing_db.read(ctx.project))
+    scheduler = Scheduler(ctx.graph, jobs, build, ctx.options.fatal,
+                          estimates=complete_estimates(ctx.graph.names, estimates))
+    ctx.result.cancelled = scheduler.run()
+
+
+def print_summary(result, options):
+    """
+    Print what happened during a build, returns the exit code of the build
+    """
+    flog.h1("Summary")
+    if result.up_to_date:
+        flog.p("%d modules were up to date", len(result.up_to_date))
+    if result.restored:
+        flog.p("%d modules were restored from the artifact cache", len(result.restored))
+
+    if result.compiler_cache_stats:
+        print_compiler_cache_stats(result.compiler_cache_stats)
+
+    if result.timeouts:
+        flog.error("%d modules were stopped because a step took too long:", len(result.timeouts))
+        for name, step in result.timeouts:
+            flog.li("%s: %s", name, step)
+
+    if result.vcs_fails:
+        fails = result.vcs_fails
+        flog.error("%d modules failed to update/checkout:", len(fails))
+        print_failures(fails, options.error_lines)
+
+    if result.build_fails:
+        fails = result.build_fails
+        flog.error("%d modules failed to build:", len(fails))
+        print_failures(fails, options.error_lines)
+
+    if result.cancelled:
+        flog.error("%d modules were not built because a module they depend on failed:",
+                   len(result.cancelled))
+        for name in result.cancelled:
+            flog.li(name)
+
+    if result.vcs_fails or result.build_fails or result.cancelled:
+        return 1
+
+    flog.p("All modules updated and built successfully")
+    return 0
+
+
+def print_failures(fails, error_line_count):
+    """
+    Print the failures listed in fails, with the first error lines of their
+    logs
+    """
+    for name, msg, log_file_name in fails:
+        flog.li("%s: %s", name, msg)
+        for line in get_error_lines(log_file_name, error_line_count):
+            flog.li("%s| %s", name, line)
+        flog.li("%s: see %s", name, log_file_name)
+
+
+def print_compiler_cache_stats(stats):
+    flog.p("Compiler cache:")
+    total_hits = 0
+    total_misses = 0
+    for name in sorted(stats):
+        hits, misses = stats[name]
+        flog.li("%s: %d hits, %d misses", name, hits, misses)
+        total_hits += hits
+        total_misses += misses
+    total = total_hits + total_misses
+    if total:
+        flog.li("Total: %d hits, %d misses (%d%% hits)", total_hits, total_misses,
+                total_hits * 100 / total)
+
+
+def print_artifact_cache_stats():
+    stats = create_artifact_cache().get_stats()
+    flog.h1("Artifact cache")
+    flog.p("%d snapshots, %s", stats["count"], format_size(stats["size"]))
+    lookups = stats["hits"] + stats["misses"]
+    if lookups:
+        flog.p("%d hits, %d misses (%d%% hit rate)",
+               stats["hits"], stats["misses"], stats["hits"] * 100 / lookups)
+    modules = sorted(stats["modules"].items(), key=lambda x: x[1][1], reverse=True)
+    for name, (count, size) in modules:
+        flog.li("%s: %d snapshots, %s", name, count, format_size(size))
+    return 0
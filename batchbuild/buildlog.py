@@ -0,0 +1,161 @@
+import gzip
+import json
+import os
+
+LOG_SUFFIX = ".log.gz"
+
+# Side file listing the error and warning lines of a log
+INDEX_SUFFIX = ".log.idx"
+
+# Build logs are large and mostly compiler command lines: favor speed
+COMPRESS_LEVEL = 1
+
+# Maximum number of lines of each kind kept in the index
+MAX_INDEX_LINES = 100
+
+# Lines longer than this are truncated in the index
+MAX_LINE_LENGTH = 500
+
+# Strings marking error and warning lines from compilers, linkers, make, ninja
+# and cmake. They are looked for with str.find(), which is much faster than a
+# regular expression on large logs.
+ERROR_MARKERS = ("error:", "Error ", "CMake Error", "FAILED: ", "undefined reference to")
+WARNING_MARKERS = ("warning:", "CMake Warning")
+
+# Prefix of the lines written by devo-batchbuild itself, such as the commands
+# it runs, which are never indexed
+OWN_LINE_PREFIX = "devo-batchbuild:"
+
+
+def _is_marker_match(text, marker, idx, line_start):
+    if marker == "Error ":
+        # make: "make[2]: *** [foo.o] Error 1"
+        return text[idx + len(marker):idx + len(marker) + 1].isdigit()
+    if marker == "FAILED: ":
+        # ninja
+        return idx == line_start
+    return True
+
+
+def get_rotated_name(file_name, suffix, number):
+    """
+    Returns the name of the log file_name, for the run number runs ago
+    """
+    base = file_name[:-len(LOG_SUFFIX)]
+    if number == 0:
+        return base + suffix
+    return "%s.%d%s" % (base, number, suffix)
+
+
+def rotate_logs(file_name, retention):
+    """
+    Rename file_name to <name>.1.log.gz, <name>.1.log.gz to <name>.2.log.gz
+    and so on, keeping only retention previous logs. Index files follow their
+    log.
+    """
+    for suffix in LOG_SUFFIX, INDEX_SUFFIX:
+        oldest = get_rotated_name(file_name, suffix, retention)
+        if os.path.exists(oldest):
+            os.unlink(oldest)
+        for number in range(retention - 1, -1, -1):
+            name = get_rotated_name(file_name, suffix, number)
+            if os.path.exists(name):
+                os.rename(name, get_rotated_name(file_name, suffix, number + 1))
+
+
+def read_index(file_name):
+    """
+    Returns the index of log file_name, or None if it has none
+    """
+    index_name = get_rotated_name(file_name, INDEX_SUFFIX, 0)
+    try:
+        with open(index_name) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def get_error_lines(file_name, count):
+    """
+    Returns the first count error lines of log file_name
+    """
+    index = read_index(file_name)
+    if not index:
+        return []
+    return [x["line"] for x in index["lines"] if x["kind"] == "error"][:count]
+
+
+class BuildLog(object):
+    """
+    A gzip-compressed log file, which keeps track of the offset of the error
+    and warning lines written to it. The offsets, in the uncompressed log, and
+    the lines themselves are written to an index file when the log is closed,
+    so that errors can be shown without reading the log again.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.size = 0
+        self.counts = {"error": 0, "warning": 0}
+        self._fp = gzip.open(file_name, "ab", COMPRESS_LEVEL)
+        self._lines = []
+        # End of the last written chunk, after its last newline
+        self._tail = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self._fp.write(data)
+        text = self._tail + data
+        base = self.size - len(self._tail)
+        self.size += len(data)
+        end = text.rfind("\n") + 1
+        self._tail = text[end:]
+        if len(self._tail) > MAX_LINE_LENGTH:
+            # Probably progress output rewriting the same line, ignore it
+            self._tail = ""
+        if end:
+            self._scan(text[:end], base)
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        if self._tail:
+            self._scan(self._tail + "\n", self.size - len(self._tail))
+            self._tail = ""
+        self._fp.close()
+        index = {"size": self.size, "counts": self.counts, "lines": self._lines}
+        index_name = get_rotated_name(self.file_name, INDEX_SUFFIX, 0)
+        with open(index_name, "w") as fp:
+            json.dump(index, fp)
+
+    def _scan(self, text, base):
+        """
+        Record the error and warning lines of text, which is made of complete
+        lines and starts at offset base in the log
+        """
+        # line start => kind
+        found = {}
+        for kind, markers in ("warning", WARNING_MARKERS), ("error", ERROR_MARKERS):
+            for marker in markers:
+                idx = text.find(marker)
+                while idx != -1:
+                    start = text.rfind("\n", 0, idx) + 1
+                    if _is_marker_match(text, marker, idx, start) \
+                            and not text.startswith(OWN_LINE_PREFIX, start):
+                        found[start] = kind
+                    idx = text.find(marker, idx + len(marker))
+
+        for start in sorted(found):
+            kind = found[start]
+            self.counts[kind] += 1
+            if self.counts[kind] > MAX_INDEX_LINES:
+                continue
+            end = text.find("\n", start)
+            line = text[start:end].rsplit("\r", 1)[-1].rstrip()
+            self._lines.append({"offset": base + start, "kind": kind,
+                                "line": line[:MAX_LINE_LENGTH]})
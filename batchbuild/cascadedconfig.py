@@ -21,3 +21,12 @@ class CascadedConfig(object):
         Returns value for key from the top-most dict only
         """
         return self._dicts[0].get(key, default)
+
+    def flatten(self):
+        """
+        Returns a dict of the effective values for all keys of the stack
+        """
+        dct = {}
+        for x in reversed(self._dicts):
+            dct.update(x)
+        return dct
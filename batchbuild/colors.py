@@ -8,21 +8,32 @@ Standard codes for shell colors.
 
 import sys
 
-if sys.stdout.isatty():
-    BOLD    = '\033[01m'
-    RED     = '\033[31m'
-    GREEN   = '\033[32m'
-    ORANGE  = '\033[33m'
-    PURPLE  = '\033[35m'
-    CYAN    = '\033[36m'
-    GREY    = '\033[37m'
-    RESET   = '\033[0;0m'
-else:
-    BOLD    = ''
-    RED     = ''
-    GREEN   = ''
-    ORANGE  = ''
-    PURPLE  = ''
-    CYAN    = ''
-    GREY    = ''
-    RESET   = ''
+CODES = {
+    "BOLD":   '\033[01m',
+    "RED":    '\033[31m',
+    "GREEN":  '\033[32m',
+    "ORANGE": '\033[33m',
+    "PURPLE": '\033[35m',
+    "CYAN":   '\033[36m',
+    "GREY":   '\033[37m',
+    "RESET":  '\033[0;0m',
+}
+
+_colors = None
+
+
+class Colors(object):
+    def __init__(self, enabled):
+        for name, code in CODES.items():
+            setattr(self, name, code if enabled else '')
+
+
+def get():
+    """
+    Returns a Colors instance, whose attributes are empty strings if stdout is
+    not a tty. stdout is only checked on the first call, not at import time.
+    """
+    global _colors
+    if _colors is None:
+        _colors = Colors(sys.stdout.isatty())
+    return _colors
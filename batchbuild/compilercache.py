@@ -0,0 +1,133 @@
+import json
+import os
+import subprocess
+
+from batchbuilderror import BatchBuildError
+
+# Dir of the compiler cache, inside DEVO_BUILD_BASE_DIR
+CACHE_DIR_NAME = ".compiler-cache"
+
+DEFAULT_MAX_SIZE = "5G"
+
+
+class BaseCompilerCache(object):
+    """
+    Base class for compiler caches. Each devo gets its own cache dir.
+    """
+    launcher = None
+
+    def __init__(self, module):
+        self.module = module
+        base_dir = os.environ["DEVO_BUILD_BASE_DIR"]
+        self.cache_dir = os.path.join(base_dir, CACHE_DIR_NAME, self.launcher)
+        self.max_size = module.config.get("compiler-cache-size", DEFAULT_MAX_SIZE)
+
+    def get_cmake_options(self):
+        return " ".join("-DCMAKE_%s_COMPILER_LAUNCHER=%s" % (x, self.launcher)
+                        for x in ("C", "CXX"))
+
+    def update_env(self, env):
+        raise NotImplementedError
+
+    def start_stats(self):
+        """
+        Called before building the module
+        """
+        pass
+
+    def get_stats(self):
+        """
+        Returns a tuple (hits, misses) for the module build, or None if they
+        could not be determined
+        """
+        return None
+
+
+class Ccache(BaseCompilerCache):
+    launcher = "ccache"
+
+    def __init__(self, module):
+        BaseCompilerCache.__init__(self, module)
+        # ccache appends the result of each compilation to this file, this lets
+        # us get stats for the module even if other modules use the cache at
+        # the same time
+        self.stats_log_name = os.path.join(module.build_dir, ".devo-batchbuild-ccache-stats")
+
+    def update_env(self, env):
+        env["CCACHE_DIR"] = self.cache_dir
+        env["CCACHE_MAXSIZE"] = self.max_size
+        env["CCACHE_STATSLOG"] = self.stats_log_name
+
+    def start_stats(self):
+        if os.path.exists(self.stats_log_name):
+            os.unlink(self.stats_log_name)
+
+    def get_stats(self):
+        if not os.path.exists(self.stats_log_name):
+            return None
+        hits = 0
+        misses = 0
+        with open(self.stats_log_name) as fp:
+            # The log contains a "# <file>" line for each compilation, followed
+            # by the names of the counters it incremented
+            for line in fp:
+                line = line.strip()
+                if line in ("direct_cache_hit", "preprocessed_cache_hit"):
+                    hits += 1
+                elif line == "cache_miss":
+                    misses += 1
+        return hits, misses
+
+
+class Sccache(BaseCompilerCache):
+    """
+    sccache runs a server shared by all builds, so stats are not accurate if
+    several modules are built at the same time
+    """
+    launcher = "sccache"
+
+    def __init__(self, module):
+        BaseCompilerCache.__init__(self, module)
+        self._start_stats = None
+
+    def update_env(self, env):
+        env["SCCACHE_DIR"] = self.cache_dir
+        env["SCCACHE_CACHE_SIZE"] = self.max_size
+
+    def start_stats(self):
+        self._start_stats = self._read_stats()
+
+    def get_stats(self):
+        stats = self._read_stats()
+        if stats is None or self._start_stats is None:
+            return None
+        return tuple(x - y for x, y in zip(stats, self._start_stats))
+
+    def _read_stats(self):
+        env = dict(os.environ)
+        self.update_env(env)
+        try:
+            with open(os.devnull, "w") as null:
+                output = subprocess.check_output(["sccache", "--show-stats", "--stats-format=json"],
+                                                 env=env, stderr=null)
+            stats = json.loads(output)["stats"]
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+            return None
+        return tuple(sum(stats.get(x, {}).get("counts", {}).values())
+                     for x in ("cache_hits", "cache_misses"))
+
+
+def create_compiler_cache(module):
+    """
+    Returns the compiler cache defined by the compiler-cache option of module,
+    or None
+    """
+    name = module.config.get("compiler-cache")
+    if not name:
+        return None
+    if name == "ccache":
+        return Ccache(module)
+    elif name == "sccache":
+        return Sccache(module)
+    else:
+        raise BatchBuildError("Invalid compiler-cache: %s, must be 'ccache' or 'sccache'" % name)
@@ -0,0 +1,86 @@
+import cPickle
+import logging
+import os
+
+
+CACHE_NAME = ".bb-cache.pickle"
+
+# Bump when the content of the cache changes
+CACHE_VERSION = 1
+
+
+def parse_yaml(full_name):
+    # Imported here so that yaml is not loaded when everything is in the cache
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(full_name) as fp:
+        return yaml.load(fp, Loader=loader)
+
+
+def create_module_index(config):
+    """
+    Returns a dict of module name => module dict
+    """
+    if not config or not config.get("modules"):
+        return {}
+    return dict((x["name"], x) for x in config["modules"])
+
+
+class ConfigCache(object):
+    """
+    Keeps parsed yaml files in a pickle file, along with an index of their
+    modules. A file is parsed again if its modification time or size changed.
+    """
+    def __init__(self, cache_dir):
+        self.file_name = os.path.join(cache_dir, CACHE_NAME)
+        self._dirty = False
+        self._entries = {}
+        try:
+            with open(self.file_name, "rb") as fp:
+                version, entries = cPickle.load(fp)
+            if version == CACHE_VERSION:
+                self._entries = entries
+        except Exception:
+            # Missing, corrupted or incompatible cache: start from scratch
+            pass
+
+    def load(self, full_name):
+        """
+        Returns the content of yaml file full_name
+        """
+        return self._get_entry(full_name)["config"]
+
+    def get_module_index(self, full_name):
+        """
+        Returns a dict of module name => module dict for yaml file full_name
+        """
+        return self._get_entry(full_name)["index"]
+
+    def save(self):
+        if not self._dirty:
+            return
+        # Forget about removed files
+        for full_name in self._entries.keys():
+            if not os.path.exists(full_name):
+                del self._entries[full_name]
+        tmp_name = self.file_name + ".tmp"
+        try:
+            with open(tmp_name, "wb") as fp:
+                cPickle.dump((CACHE_VERSION, self._entries), fp, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_name, self.file_name)
+        except (IOError, OSError), exc:
+            logging.warning("Could not save config cache: %s", exc)
+            return
+        self._dirty = False
+
+    def _get_entry(self, full_name):
+        full_name = os.path.abspath(full_name)
+        stat = os.stat(full_name)
+        key = (stat.st_mtime, stat.st_size)
+        entry = self._entries.get(full_name)
+        if entry is None or entry["key"] != key:
+            config = parse_yaml(full_name)
+            entry = {"key": key, "config": config, "index": create_module_index(config)}
+            self._entries[full_name] = entry
+            self._dirty = True
+        return entry
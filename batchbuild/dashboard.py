@@ -0,0 +1,220 @@
+import fcntl
+import json
+import os
+import struct
+import sys
+import termios
+import threading
+import time
+
+import flog
+from timingdb import STEPS, format_duration
+
+# Delay between two refreshes of the dashboard, in seconds
+REFRESH_INTERVAL = 1.0
+
+# Progress is only used to estimate the remaining time of a step once it is
+# past this value, before that it is too noisy
+MIN_ETA_PROGRESS = 0.05
+
+# Module states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+UP_TO_DATE = "up-to-date"
+CANCELLED = "cancelled"
+
+
+def get_terminal_width(fd):
+    try:
+        _, width = struct.unpack("hh", fcntl.ioctl(fd, termios.TIOCGWINSZ, "1234"))
+    except IOError:
+        width = 0
+    return width or 80
+
+
+class ModuleStatus(object):
+    """
+    What a module is doing. Runners update it through start_step(),
+    set_progress() and end_step().
+    """
+    def __init__(self, dashboard, name, step_estimates):
+        self._dashboard = dashboard
+        self.name = name
+        # step => estimated duration
+        self.step_estimates = step_estimates or {}
+        self.estimate = sum(self.step_estimates.values()) if step_estimates else None
+        self.state = PENDING
+        self.start_time = None
+        self.end_time = None
+        self.step = None
+        self.step_start_time = None
+        self.progress = None
+
+    def start(self):
+        with self._dashboard.lock:
+            if self.state == PENDING:
+                self.state = RUNNING
+                self.start_time = time.time()
+
+    def start_step(self, step):
+        # Fetcher threads run steps before the module build starts
+        self.start()
+        with self._dashboard.lock:
+            self.step = step
+            self.step_start_time = time.time()
+            self.progress = None
+
+    def set_progress(self, progress):
+        with self._dashboard.lock:
+            self.progress = progress
+
+    def end_step(self):
+        with self._dashboard.lock:
+            self.step = None
+            self.progress = None
+
+    def finish(self, state):
+        with self._dashboard.lock:
+            self.state = state
+            self.step = None
+            self.progress = None
+            self.end_time = time.time()
+
+    def get_eta(self, now):
+        """
+        Returns the estimated remaining time of the module, in seconds, or
+        None if there is no way to estimate it. If the running step reports
+        its progress, the remaining time of the step is estimated from it, and
+        the steps which follow it are estimated from the previous builds.
+        Otherwise the duration of the previous builds is used.
+        """
+        if self.state != RUNNING:
+            return None
+        if self.progress is not None and self.progress >= MIN_ETA_PROGRESS:
+            elapsed = now - self.step_start_time
+            remaining = elapsed * (1 - self.progress) / self.progress
+            if self.step in STEPS:
+                later_steps = STEPS[STEPS.index(self.step) + 1:]
+                remaining += sum(self.step_estimates.get(x, 0) for x in later_steps)
+            return remaining
+        if self.estimate is None:
+            return None
+        return max(self.estimate - (now - self.start_time), 0)
+
+    def to_dict(self, now):
+        return {
+            "state": self.state,
+            "step": self.step,
+            "progress": self.progress,
+            "start": self.start_time,
+            "end": self.end_time,
+            "eta": self.get_eta(now),
+        }
+
+
+class Dashboard(object):
+    """
+    Tracks the state of all modules of a build, and every REFRESH_INTERVAL
+    seconds:
+    - draws a line per running module at the bottom of the terminal, if
+      use_tty is True
+    - writes the state of all modules to status_file_name, if set, as json
+
+    step_estimates is a dict of name => dict of step => estimated duration,
+    from the previous builds.
+    """
+    def __init__(self, project, names, step_estimates, use_tty=False, status_file_name=None):
+        self.project = project
+        self.use_tty = use_tty
+        self.status_file_name = status_file_name
+        self.lock = threading.RLock()
+        self._statuses = [ModuleStatus(self, x, step_estimates.get(x)) for x in names]
+        self._status_for_name = dict((x.name, x) for x in self._statuses)
+        self._drawn_lines = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def get_status(self, name):
+        return self._status_for_name[name]
+
+    def start(self):
+        if self.use_tty:
+            flog.set_status_area(self)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self._write_status_file()
+        if self.use_tty:
+            with flog.lock:
+                self.clear()
+                flog.set_status_area(None)
+
+    def clear(self):
+        """
+        Erase the lines drawn by draw(). Must be called with flog.lock held.
+        """
+        if not self._drawn_lines:
+            return
+        # Move to the first drawn line, then erase to the end of the screen
+        sys.stdout.write("\033[%dA\r\033[J" % self._drawn_lines)
+        sys.stdout.flush()
+        self._drawn_lines = 0
+
+    def draw(self):
+        """
+        Draw the status lines. Must be called with flog.lock held.
+        """
+        if self._drawn_lines:
+            return
+        lines = self._format_lines(time.time())
+        width = get_terminal_width(sys.stdout.fileno())
+        sys.stdout.write("".join(x[:width - 1] + "\n" for x in lines))
+        sys.stdout.flush()
+        self._drawn_lines = len(lines)
+
+    def _run(self):
+        while not self._stop_event.wait(REFRESH_INTERVAL):
+            if self.use_tty:
+                with flog.lock:
+                    self.clear()
+                    self.draw()
+            self._write_status_file()
+
+    def _format_lines(self, now):
+        with self.lock:
+            done = sum(1 for x in self._statuses if x.state not in (PENDING, RUNNING))
+            lines = ["-- %d/%d modules done" % (done, len(self._statuses))]
+            for status in self._statuses:
+                if status.state != RUNNING:
+                    continue
+                details = [status.step or "waiting"]
+                if status.progress is not None:
+                    details.append("%d%%" % (status.progress * 100))
+                details.append(format_duration(now - status.start_time))
+                eta = status.get_eta(now)
+                if eta is not None:
+                    details.append("ETA %s" % format_duration(eta))
+                lines.append("   %s: %s" % (status.name, ", ".join(details)))
+        return lines
+
+    def _write_status_file(self):
+        if not self.status_file_name:
+            return
+        now = time.time()
+        with self.lock:
+            dct = {
+                "project": self.project,
+                "updated": now,
+                "modules": dict((x.name, x.to_dict(now)) for x in self._statuses),
+                "order": [x.name for x in self._statuses],
+            }
+        tmp_name = self.status_file_name + ".tmp"
+        with open(tmp_name, "w") as fp:
+            json.dump(dct, fp, indent=2, sort_keys=True)
+        os.rename(tmp_name, self.status_file_name)
@@ -1,19 +1,24 @@
 #!/usr/bin/env python
+import atexit
 import itertools
 import logging
 import os
 import sys
 from optparse import OptionParser
 
-import yaml
-
 import flog
-import nanotify
 
 from batchbuilderror import BatchBuildError
 from cascadedconfig import CascadedConfig
-from module import Module
-from runner import Runner
+from configcache import ConfigCache
+from report import print_report, print_target_report
+from scheduler import ModuleGraph, complete_estimates, plan_schedule
+from targetprofile import TargetDb
+from timingdb import TimingDb, estimate_durations, format_duration
+
+# The modules needed to update and build (builder, module, runner, vcs...) are
+# only imported by main() when it gets there, so that -l and --dry-run, which
+# are used from shell completion, start fast
 
 USAGE = "%prog <project[.yaml]> [module1 [module2...]]"
 
@@ -22,6 +27,20 @@ BBCONFIG_DIR = os.path.join(DEVO_OVERLAY_DIR, "bb")
 BASE_CONFIG_NAME = "_base.yaml"
 
 
+_config_cache = None
+
+
+def get_config_cache():
+    """
+    Returns the ConfigCache for BBCONFIG_DIR, it is saved when we exit
+    """
+    global _config_cache
+    if _config_cache is None:
+        _config_cache = ConfigCache(BBCONFIG_DIR)
+        atexit.register(_config_cache.save)
+    return _config_cache
+
+
 def load_base_config_dict():
     """
     Load content of BASE_CONFIG_NAME
@@ -29,7 +48,7 @@ def load_base_config_dict():
     full_name = os.path.join(BBCONFIG_DIR, BASE_CONFIG_NAME)
     if not os.path.exists(full_name):
         return {}
-    return yaml.load(open(full_name))
+    return get_config_cache().load(full_name)
 
 
 def list_yaml_files():
@@ -44,21 +63,31 @@ def list_yaml_files():
         yield name
 
 
-def load_config_dict_by_name(name):
+def find_config_file(name):
     """
-    Returns config dict for config named name, or None
+    Returns the path of the config named name, or None
     """
     full_name = os.path.join(BBCONFIG_DIR, name)
     for x in name, full_name:
         if os.path.exists(x):
-            return yaml.load(open(x))
+            return x
     return None
 
 
+def load_config_dict_by_name(name):
+    """
+    Returns config dict for config named name, or None
+    """
+    full_name = find_config_file(name)
+    if full_name is None:
+        return None
+    return get_config_cache().load(full_name)
+
+
 def print_all_project_modules():
     for name in sorted(list_yaml_files()):
         full_name = os.path.join(BBCONFIG_DIR, name)
-        config = yaml.load(open(full_name))
+        config = get_config_cache().load(full_name)
         flog.h1(name)
         print_project_modules(config)
 
@@ -69,13 +98,8 @@ def print_project_modules(config):
 
 
 def select_modules_from_config(config_name, module_names, base_dict):
-    def find_module(lst, name):
-        for dct in lst:
-            if dct["name"] == name:
-                return dct
-        return None
-
-    config = load_config_dict_by_name(config_name)
+    full_name = find_config_file(config_name)
+    config = get_config_cache().load(full_name) if full_name else None
     if not config:
         flog.error("Could not find '%s' config file" % config_name)
         return None
@@ -84,9 +108,10 @@ def select_modules_from_config(config_name, module_names, base_dict):
     if not module_names:
         return [CascadedConfig(x, global_dict, base_dict) for x in module_dicts]
 
+    module_index = get_config_cache().get_module_index(full_name)
     lst = []
     for module_name in module_names:
-        dct = find_module(module_dicts, module_name)
+        dct = module_index.get(module_name)
         if dct is None:
             flog.error("Unknown module %s" % module_name)
             return None
@@ -94,85 +119,75 @@ def select_modules_from_config(config_name, module_names, base_dict):
     return lst
 
 
-def find_module_config(lst, name):
-    for idx, config in enumerate(lst):
-        if config.flat_get("name") == name:
-            return idx
-    return -1
-
-
-def apply_resume_from(lst, name):
-    idx = find_module_config(lst, name)
-    if idx == -1:
+def apply_resume_from(order, name):
+    if name not in order:
         flog.error("Unknown module %s" % name)
         return None
-    return lst[idx:]
+    return order[order.index(name):]
 
 
-def apply_resume_after(lst, name):
-    idx = find_module_config(lst, name)
-    if idx == -1:
+def apply_resume_after(order, name):
+    if name not in order:
         flog.error("Unknown module %s" % name)
         return None
-    if idx == len(lst) - 1:
+    idx = order.index(name)
+    if idx == len(order) - 1:
         flog.error("No module after %s" % name)
         return None
-    return lst[idx + 1:]
-
-
-class BuildResult(object):
-    def __init__(self):
-        self.vcs_fails = []
-        self.build_fails = []
-
-
-def do_build(module_configs, log_dir, options):
-    result = BuildResult()
-    nb_modules = len(module_configs)
-    for idx, config in enumerate(module_configs):
-        name = config.flat_get("name")
-        assert name
-        flog.h1("%d/%d %s" % (idx + 1, nb_modules, name))
-        module = Module(config)
-        log_file_name = os.path.join(log_dir, name.replace("/", "_") + ".log")
-        log_file = open(log_file_name, "w")
-        runner = Runner(log_file, options.verbose)
-
-        # update/checkout
-        if options.switch_branch and module.has_checkout():
-            module.switch_branch(runner)
-
-        if not options.no_src:
-            try:
-                if module.has_checkout():
-                    module.update(runner)
-                else:
-                    module.checkout(runner)
-            except BatchBuildError, exc:
-                flog.error("%s failed to update/checkout: %s", name, exc)
-                flog.p("See %s", log_file_name)
-                result.vcs_fails.append([name, str(exc), log_file_name])
-                nanotify.notify(name, "Failed to update/checkout", icon="dialog-warning")
-                if options.fatal:
-                    return result
-
-        # Build
+    return order[idx + 1:]
+
+
+def print_schedule(project, graph, log_dir, options):
+    """
+    Print the modules which would be built, in the order they would be
+    started, with estimated durations from previous runs
+    """
+    known = estimate_durations(TimingDb(log_dir).read(project))
+    estimates = complete_estimates(graph.names, known)
+    if options.jobs > 1:
+        plan, makespan = plan_schedule(graph, options.jobs, estimates)
+    else:
+        plan = []
+        makespan = 0
+        for name in graph.order:
+            plan.append((makespan, name))
+            makespan += estimates[name]
+
+    flog.p("Would build:")
+    for start, name in plan:
+        if known:
+            flog.li("+%s %s (%s%s)", format_duration(start), name,
+                    format_duration(estimates[name]), "" if name in known else ", guessed")
+        else:
+            flog.li(name)
+    if known:
+        flog.p("Estimated total time: %s", format_duration(makespan))
+
+
+def do_report(args, options):
+    log_dir = os.path.join(os.environ["DEVO_BUILD_BASE_DIR"], "log")
+    timing_db = TimingDb(log_dir)
+    if args:
+        config_name = args[0]
+        if not config_name.endswith(".yaml"):
+            config_name += ".yaml"
+    else:
+        entries = list(timing_db.read())
+        if not entries:
+            flog.error("No build timings recorded")
+            return 1
+        config_name = entries[-1]["project"]
+
+    graph = None
+    module_configs = select_modules_from_config(config_name, [], load_base_config_dict())
+    if module_configs:
         try:
-            if not options.src_only:
-                if options.refresh_build:
-                    module.refresh_build()
-                module.configure(runner)
-                module.build(runner)
-                module.install(runner)
-                nanotify.notify(name, "Build successfully", icon="dialog-ok")
+            graph = ModuleGraph(module_configs)
         except BatchBuildError, exc:
-            flog.error("%s failed to build: %s", name, exc)
-            flog.p("See %s", log_file_name)
-            result.build_fails.append([name, str(exc), log_file_name])
-            nanotify.notify(name, "Failed to build", icon="dialog-error")
-            if options.fatal:
-                return result
-    return result
+            flog.error("%s", exc)
+    ret = print_report(timing_db, config_name, graph, options.report_runs)
+    print_target_report(TargetDb(log_dir), config_name)
+    return ret
 
 
 def main():
@@ -196,16 +211,32 @@ def main():
 
     parser.add_option("--resume-from", dest="resume_from", default=None,
                       metavar="MODULE",
-                      help="Resume build from MODULE")
+                      help="Resume build from MODULE, in build order")
 
     parser.add_option("--resume-after", dest="resume_after", default=None,
                       metavar="MODULE",
-                      help="Resume build after MODULE")
+                      help="Resume build after MODULE, in build order")
 
     parser.add_option("--refresh-build",
                       action="store_true", dest="refresh_build", default=False,
                       help="Delete build dir")
 
+    parser.add_option("--reconfigure",
+                      action="store_true", dest="reconfigure", default=False,
+                      help="Run the configure step even if the build dir is already configured")
+
+    parser.add_option("--force",
+                      action="store_true", dest="force", default=False,
+                      help="Build modules even if nothing changed since their last successful build")
+
+    parser.add_option("--uninstall",
+                      action="store_true", dest="uninstall", default=False,
+                      help="Remove the files installed by the modules instead of building them")
+
+    parser.add_option("--clean-install",
+                      action="store_true", dest="clean_install", default=False,
+                      help="Remove the files installed by a module before installing it again")
+
     parser.add_option("--switch-branch",
                       action="store_true", dest="switch_branch", default=False,
                       help="Switch to the branch defined for a module before updating")
@@ -216,11 +247,103 @@ def main():
 
     parser.add_option("--fatal",
                       action="store_true", dest="fatal", default=False,
-                      help="Stop on first build failure")
+                      help="Stop on first build failure. With --jobs, only cancel the modules depending on the failed one")
+
+    parser.add_option("-j", "--jobs", type="int",
+                      dest="jobs", default=1, metavar="N",
+                      help="Build up to N independent modules at the same time")
+
+    parser.add_option("--fetch-jobs", type="int",
+                      dest="fetch_jobs", default=0, metavar="N",
+                      help="Update/checkout the source of up to N modules at the same time, in the background. Modules are built as soon as their source is ready")
+
+    parser.add_option("--check-upstream",
+                      action="store_true", dest="check_upstream", default=False,
+                      help="Check all remote repositories first and only update modules with upstream changes")
+
+    parser.add_option("--check-only",
+                      action="store_true", dest="check_only", default=False,
+                      help="Only list the modules with upstream changes")
+
+    parser.add_option("--check-jobs", type="int",
+                      dest="check_jobs", default=8, metavar="N",
+                      help="Check up to N remote repositories at the same time (defaults to 8)")
+
+    parser.add_option("--refresh-mirrors",
+                      action="store_true", dest="refresh_mirrors", default=False,
+                      help="Create or update the mirrors of git modules before building")
+
+    parser.add_option("--mirror-jobs", type="int",
+                      dest="mirror_jobs", default=8, metavar="N",
+                      help="Refresh up to N mirrors at the same time (defaults to 8)")
+
+    parser.add_option("--total-jobs", type="int",
+                      dest="total_jobs", default=None, metavar="N",
+                      help="Share N build jobs between all running builds through a make jobserver. Defaults to the number of CPUs if --jobs is used")
+
+    parser.add_option("--max-load", type="float",
+                      dest="max_load", default=None, metavar="LOAD",
+                      help="Do not start new build jobs if the load average is above LOAD")
+
+    parser.add_option("--dashboard",
+                      action="store_true", dest="dashboard", default=False,
+                      help="Show the progress and estimated remaining time of running modules at the bottom of the terminal")
+
+    parser.add_option("--status-file",
+                      dest="status_file", default=None, metavar="FILE",
+                      help="Where to write the state of modules during the build, as json. Defaults to status.json in the log dir")
+
+    parser.add_option("--log-retention", type="int",
+                      dest="log_retention", default=5, metavar="N",
+                      help="Number of previous logs to keep for each module")
+
+    parser.add_option("--error-lines", type="int",
+                      dest="error_lines", default=10, metavar="N",
+                      help="Number of error lines to show for each failed module")
+
+    parser.add_option("--notify",
+                      dest="notify", default="auto", metavar="BACKEND",
+                      help="Where to send notifications: 'dbus', 'none', 'file:<path>' or 'auto' (the default), which uses dbus if there is a D-Bus session")
+
+    parser.add_option("--watch",
+                      action="store_true", dest="watch", default=False,
+                      help="After building, keep watching the source of the modules, and rebuild the modules which change and the modules depending on them")
+
+    parser.add_option("--workers",
+                      dest="workers", default=None, metavar="WORKERS",
+                      help="Build modules on workers instead of locally. WORKERS is a comma-separated list of 'ssh:<host>', 'local' or 'local:<dir>'. Install commands must honour DESTDIR")
+
+    parser.add_option("--worker",
+                      action="store_true", dest="worker", default=False,
+                      help="Run as a worker, serving build requests on stdin (used by --workers)")
+
+    parser.add_option("--jobserver-fifo",
+                      action="store_true", dest="jobserver_fifo", default=False,
+                      help="Use a named pipe for the jobserver (requires make >= 4.4, supported by ninja >= 1.13)")
+
+    parser.add_option("--report",
+                      action="store_true", dest="report", default=False,
+                      help="Show where time was spent during the last builds of the project (defaults to the last built project)")
+
+    parser.add_option("--profile",
+                      action="store_true", dest="profile", default=False,
+                      help="Record the time spent on each target of modules built with ninja, shown by --report")
+
+    parser.add_option("--report-runs", type="int",
+                      dest="report_runs", default=5, metavar="N",
+                      help="Number of runs to show trends for in --report")
+
+    parser.add_option("--cache-stats",
+                      action="store_true", dest="cache_stats", default=False,
+                      help="Show the content of the artifact cache of the devo")
 
     (options, args) = parser.parse_args()
     logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%H:%M:%S", level=logging.DEBUG)
 
+    if options.worker:
+        import remote
+        return remote.run_worker()
+
     if options.list:
         if len(args) > 0:
             name = args[0]
@@ -240,6 +363,13 @@ def main():
         return 1
     flog.p("Using devo '%s'", devo_name)
 
+    if options.report:
+        return do_report(args, options)
+
+    if options.cache_stats:
+        import builder
+        return builder.print_artifact_cache_stats()
+
     # Load config
     if len(args) == 0:
         parser.error("Missing args")
@@ -253,12 +383,24 @@ def main():
     if module_configs is None:
         return 1
 
+    try:
+        graph = ModuleGraph(module_configs)
+    except BatchBuildError, exc:
+        flog.error("%s", exc)
+        return 1
+
+    # Resume in build order, which is not the list order when modules have
+    # depends-on options
+    names = graph.order
     if options.resume_from:
-        module_configs = apply_resume_from(module_configs, options.resume_from)
-    if options.resume_after:
-        module_configs = apply_resume_after(module_configs, options.resume_after)
-    if module_configs is None:
+        names = apply_resume_from(names, options.resume_from)
+    if options.resume_after and names is not None:
+        names = apply_resume_after(names, options.resume_after)
+    if names is None:
         return 1
+    if names != graph.order:
+        graph = graph.subgraph(names)
+        module_configs = graph.configs
 
     # Setup logging
     log_dir = os.path.join(os.environ["DEVO_BUILD_BASE_DIR"], "log")
@@ -266,33 +408,42 @@ def main():
         os.makedirs(log_dir)
 
     if options.dry_run:
-        flog.p("Would build:")
-        for module_config in module_configs:
-            flog.li(module_config.flat_get("name"))
+        print_schedule(config_name, graph, log_dir, options)
         return 0
 
-    result = do_build(module_configs, log_dir, options)
-
-    flog.h1("Summary")
-    if result.vcs_fails:
-        fails = result.vcs_fails
-        flog.error("%d modules failed to update/checkout:", len(fails))
-        for name, msg, log_file_name in fails:
-            flog.li("%s: %s", name, msg)
-            flog.li("%s: see %s", name, log_file_name)
+    import builder
+    import nanotify
 
-    if result.build_fails:
-        fails = result.build_fails
-        flog.error("%d modules failed to build:", len(fails))
-        for name, msg, log_file_name in fails:
-            flog.li("%s: %s", name, msg)
-            flog.li("%s: see %s", name, log_file_name)
+    if options.uninstall:
+        try:
+            return builder.do_uninstall(graph, log_dir, options)
+        except BatchBuildError, exc:
+            flog.error("%s", exc)
+            return 1
+
+    if options.refresh_mirrors:
+        flog.h1("Refreshing mirrors")
+        if builder.refresh_mirrors(module_configs, log_dir, options) and options.fatal:
+            return 1
+
+    if options.check_only:
+        outdated = builder.check_upstream(module_configs, options)
+        flog.p("%d modules have upstream changes:", len(outdated))
+        for name in graph.names:
+            if name in outdated:
+                flog.li(name)
+        return 0
 
-    if result.vcs_fails or result.build_fails:
+    try:
+        nanotify.setup(options.notify, "devo-batchbuild")
+        if options.watch:
+            return builder.do_watch(config_name, graph, log_dir, options)
+        result = builder.do_build(config_name, graph, log_dir, options)
+    except BatchBuildError, exc:
+        flog.error("%s", exc)
         return 1
 
-    flog.p("All modules updated and built successfully")
-    return 0
+    return builder.print_summary(result, options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import logging
+import threading
+import Queue
+
+
+class SourceFetcher(object):
+    """
+    Updates or checks out the source of modules in background threads, so that
+    a module can be built as soon as its own source is ready.
+
+    fetch_fn(name) is called for each module name, in order, from up to `jobs`
+    threads. It must return True on success.
+    """
+    def __init__(self, names, jobs, fetch_fn):
+        self.fetch_fn = fetch_fn
+        self._queue = Queue.Queue()
+        self._events = {}
+        self._results = {}
+        self._stopped = False
+        for name in names:
+            self._events[name] = threading.Event()
+            self._queue.put(name)
+        self._threads = []
+        for idx in range(min(jobs, len(names))):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Skip the modules which have not been fetched yet, and wait for the
+        fetches in progress to finish
+        """
+        self._stopped = True
+        for thread in self._threads:
+            # Use a timeout so that KeyboardInterrupt is not blocked
+            while thread.is_alive():
+                thread.join(1)
+
+    def wait(self, name):
+        """
+        Blocks until the source of module name has been fetched. Returns True
+        if it was successful
+        """
+        event = self._events[name]
+        # Use a timeout so that KeyboardInterrupt is not blocked
+        while not event.wait(1):
+            pass
+        return self._results[name]
+
+    def _work(self):
+        while True:
+            try:
+                name = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            ok = False
+            if not self._stopped:
+                try:
+                    ok = self.fetch_fn(name)
+                except Exception:
+                    logging.exception("Unexpected error while fetching %s", name)
+            self._results[name] = ok
+            self._events[name].set()
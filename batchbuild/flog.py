@@ -3,7 +3,40 @@
 Fancy log
 """
 import colors
+import contextlib
 import sys
+import threading
+
+# Held while writing to stdout, so that output from concurrent builds does not
+# get mixed
+lock = threading.RLock()
+
+# Lines kept at the bottom of the terminal, see set_status_area()
+_status_area = None
+
+def set_status_area(area):
+    """
+    area is an object with clear() and draw() methods, which erase and draw
+    lines at the bottom of the terminal. It is erased before writing to
+    stdout and drawn again afterwards. Pass None to remove it.
+    """
+    global _status_area
+    with lock:
+        _status_area = area
+
+@contextlib.contextmanager
+def output():
+    """
+    Hold while writing to stdout
+    """
+    with lock:
+        if _status_area:
+            _status_area.clear()
+        try:
+            yield
+        finally:
+            if _status_area:
+                _status_area.draw()
 
 def h1(txt, *args):
     _heading(1, txt, *args)
@@ -12,18 +45,24 @@ def h2(txt, *args):
     _heading(2, txt, *args)
 
 def error(txt, *args):
-    print colors.RESET + colors.RED + (txt % args) + colors.RESET
+    c = colors.get()
+    with output():
+        print c.RESET + c.RED + (txt % args) + c.RESET
 
 def p(txt, *args):
-    print txt % args
+    with output():
+        print txt % args
 
 def li(txt, *args):
-    print txt % args
+    with output():
+        print txt % args
 
 def _heading(level, txt, *args):
-    sys.stdout.write(colors.BOLD)
-    sys.stdout.write(colors.GREEN)
-    if level == 1:
-        print colors.BOLD
-    print "#" * level, txt % args
-    print colors.RESET
+    c = colors.get()
+    with output():
+        sys.stdout.write(c.BOLD)
+        sys.stdout.write(c.GREEN)
+        if level == 1:
+            print c.BOLD
+        print "#" * level, txt % args
+        print c.RESET
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+from cStringIO import StringIO
+
+# Dir of install manifests, inside DEVO_BUILD_BASE_DIR. It is not inside the
+# module build dirs so that manifests survive --refresh-build
+MANIFEST_DIR_NAME = ".install-manifests"
+
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(1024 * 1024)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+class InstallManifest(object):
+    """
+    The list of files installed by a module. Each file is associated with a
+    dict containing either:
+    - "hash", "size" and "mtime" for regular files
+    - "link" for symbolic links
+    """
+    def __init__(self, module_name):
+        base_dir = os.path.join(os.environ["DEVO_BUILD_BASE_DIR"], MANIFEST_DIR_NAME)
+        self.file_name = os.path.join(base_dir, module_name.replace("/", "_") + ".json")
+        self.files = {}
+        if os.path.exists(self.file_name):
+            try:
+                with open(self.file_name) as fp:
+                    self.files = json.load(fp)
+            except ValueError:
+                logging.warning("Ignoring corrupted install manifest %s", self.file_name)
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def save(self):
+        dir_name = os.path.dirname(self.file_name)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, "w") as fp:
+            json.dump(self.files, fp, indent=2, sort_keys=True)
+        os.rename(tmp_name, self.file_name)
+
+    def get_installed_hash(self, path):
+        """
+        Returns the hash of the installed file path, using the hash stored in
+        the manifest if the file has not been touched since it was installed
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        info = self.files.get(path)
+        if info and info.get("size") == st.st_size and info.get("mtime") == st.st_mtime:
+            return info["hash"]
+        return hash_file(path)
+
+
+def read_cmake_manifest(build_dir, manifest):
+    """
+    Fill manifest with the files listed in the install_manifest.txt file
+    CMake writes when installing. Returns False if there is no such file.
+    """
+    name = os.path.join(build_dir, "install_manifest.txt")
+    if not os.path.exists(name):
+        return False
+    with open(name) as fp:
+        manifest.files = dict((x.strip(), {}) for x in fp if x.strip())
+    return True
+
+
+def uninstall(manifest):
+    """
+    Remove the files listed in manifest, then the manifest itself. Dirs left
+    empty are removed if they are inside DEVO_PREFIX. Returns the number of
+    removed files.
+    """
+    prefix = os.environ.get("DEVO_PREFIX")
+    removed = 0
+    dir_names = set()
+    for path in manifest.files:
+        if os.path.islink(path) or os.path.isfile(path):
+            os.unlink(path)
+            removed += 1
+            dir_names.add(os.path.dirname(path))
+
+    if prefix:
+        prefix = os.path.abspath(prefix)
+        # Longest paths first, so that children are removed before parents
+        for dir_name in sorted(dir_names, key=len, reverse=True):
+            while dir_name.startswith(prefix + "/"):
+                try:
+                    os.rmdir(dir_name)
+                except OSError:
+                    # Not empty
+                    break
+                dir_name = os.path.dirname(dir_name)
+
+    manifest.files = {}
+    if manifest.exists():
+        os.unlink(manifest.file_name)
+    return removed
+
+
+def pack_files(file_names, prefix):
+    """
+    Returns a tar.gz archive of the files of file_names which are inside
+    prefix, stored with paths relative to prefix
+    """
+    prefix = os.path.abspath(prefix)
+    data = StringIO()
+    with tarfile.open(fileobj=data, mode="w:gz", compresslevel=1) as tar:
+        for file_name in sorted(file_names):
+            if file_name.startswith(prefix + "/") and os.path.lexists(file_name):
+                tar.add(file_name, os.path.relpath(file_name, prefix), recursive=False)
+    return data.getvalue()
+
+
+def install_packed_files(data, prefix, manifest):
+    """
+    Install the files of an archive created by pack_files() inside prefix,
+    as install_from_stage() does. Returns the same tuple.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="devo-batchbuild-")
+    try:
+        stage_prefix = os.path.join(tmp_dir, os.path.abspath(prefix).lstrip("/"))
+        with tarfile.open(fileobj=StringIO(data), mode="r:gz") as tar:
+            tar.extractall(stage_prefix)
+        return install_from_stage(tmp_dir, manifest)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def install_from_stage(stage_dir, manifest):
+    """
+    Install the files staged in stage_dir, as installed with DESTDIR=stage_dir,
+    replacing only the files whose content changed and removing the files
+    listed in manifest which are not staged anymore. manifest is updated.
+
+    Returns a tuple (changed, unchanged, removed) with file counts.
+    """
+    changed = 0
+    unchanged = 0
+    new_files = {}
+    for dir_path, dir_names, file_names in os.walk(stage_dir):
+        dest_dir = os.path.join("/", os.path.relpath(dir_path, stage_dir))
+        # os.walk() does not descend into symlinks to dirs, handle them as files
+        for name in file_names + [x for x in dir_names if os.path.islink(os.path.join(dir_path, x))]:
+            src = os.path.join(dir_path, name)
+            dest = os.path.join(dest_dir, name)
+            if os.path.islink(src):
+                info = {"link": os.readlink(src)}
+                if os.path.islink(dest) and os.readlink(dest) == info["link"]:
+                    unchanged += 1
+                else:
+                    _install_link(info["link"], dest)
+                    changed += 1
+            else:
+                src_hash = hash_file(src)
+                if manifest.get_installed_hash(dest) == src_hash:
+                    unchanged += 1
+                else:
+                    _install_file(src, dest)
+                    changed += 1
+                st = os.stat(dest)
+                info = {"hash": src_hash, "size": st.st_size, "mtime": st.st_mtime}
+            new_files[dest] = info
+
+    removed = 0
+    for path in set(manifest.files) - set(new_files):
+        if os.path.islink(path) or os.path.isfile(path):
+            os.unlink(path)
+            removed += 1
+
+    manifest.files = new_files
+    manifest.save()
+    return changed, unchanged, removed
+
+
+def _prepare_dest(dest):
+    dir_name = os.path.dirname(dest)
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    return os.path.join(dir_name, ".%s.devo-batchbuild-tmp" % os.path.basename(dest))
+
+
+def _install_file(src, dest):
+    # Copy to a temporary file and rename it, so that the file is never seen
+    # half-written
+    tmp_name = _prepare_dest(dest)
+    shutil.copyfile(src, tmp_name)
+    shutil.copymode(src, tmp_name)
+    os.rename(tmp_name, dest)
+
+
+def _install_link(target, dest):
+    tmp_name = _prepare_dest(dest)
+    if os.path.lexists(tmp_name):
+        os.unlink(tmp_name)
+    os.symlink(target, tmp_name)
+    os.rename(tmp_name, dest)
@@ -0,0 +1,110 @@
+import contextlib
+import os
+import re
+import select
+import shutil
+import tempfile
+import threading
+
+
+# Matches -jN, -j N and --jobs=N options
+JOBS_OPTION_RX = re.compile(r"(^|\s)(-j\s*\d*|--jobs(=\d+)?)(?=\s|$)")
+
+
+def strip_jobs_option(options):
+    """
+    Removes the -jN options from a string of build options
+    """
+    return JOBS_OPTION_RX.sub("", options).strip()
+
+
+def parse_jobs_option(options):
+    """
+    Returns the number of jobs set by the last -jN option of a string of
+    build options, 0 for a -j option without number, or None if there is none
+    """
+    matches = JOBS_OPTION_RX.findall(options)
+    if not matches:
+        return None
+    digits = "".join(x for x in matches[-1][1] if x.isdigit())
+    return int(digits) if digits else 0
+
+
+class JobServer(object):
+    """
+    A GNU make jobserver: a pipe holding one token per job slot, shared by all
+    make processes started by devo-batchbuild, so that they do not run more
+    than total_jobs jobs at the same time.
+
+    make processes find the jobserver through the MAKEFLAGS environment
+    variable. By default the pipe file descriptors are passed, which works with
+    all versions of make. If use_fifo is True, a named pipe is used instead,
+    this requires make >= 4.4 or ninja >= 1.13.
+
+    Each module holds tokens while it builds, see reserve(): one for the
+    implicit token of its top-level make, or N if it runs with its own -jN,
+    outside of the jobserver, so that its jobs count in the total.
+    """
+    def __init__(self, total_jobs, max_load=None, use_fifo=False):
+        self.total_jobs = total_jobs
+        self.max_load = max_load
+        self.fifo_name = None
+        self._tmp_dir = None
+        if use_fifo:
+            self._tmp_dir = tempfile.mkdtemp(prefix="devo-batchbuild-")
+            self.fifo_name = os.path.join(self._tmp_dir, "jobserver")
+            os.mkfifo(self.fifo_name, 0600)
+            self.read_fd = os.open(self.fifo_name, os.O_RDWR)
+            self.write_fd = self.read_fd
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+        # Only one thread acquires tokens at a time, so that modules waiting
+        # for several tokens do not each hold some of them forever
+        self._acquire_lock = threading.Lock()
+        os.write(self.write_fd, "+" * total_jobs)
+
+    def get_makeflags(self):
+        if self.fifo_name:
+            flags = "-j --jobserver-auth=fifo:%s" % self.fifo_name
+        else:
+            flags = "-j --jobserver-fds=%d,%d" % (self.read_fd, self.write_fd)
+        if self.max_load:
+            flags += " -l %s" % self.max_load
+        return flags
+
+    def update_env(self, env):
+        """
+        Add the jobserver to the MAKEFLAGS of env
+        """
+        env["MAKEFLAGS"] = (self.get_makeflags() + " " + env.get("MAKEFLAGS", "")).strip()
+
+    @contextlib.contextmanager
+    def reserve(self, count):
+        """
+        Hold count tokens, at most total_jobs, while in the context
+        """
+        count = min(count, self.total_jobs)
+        tokens = ""
+        try:
+            with self._acquire_lock:
+                while len(tokens) < count:
+                    tokens += self._read_token()
+            yield
+        finally:
+            if tokens:
+                os.write(self.write_fd, tokens)
+
+    def _read_token(self):
+        # Wait with a timeout so that KeyboardInterrupt is not blocked. Make
+        # processes may take the token between select() and read(), then
+        # read() waits for the next token.
+        while not select.select([self.read_fd], [], [], 1)[0]:
+            pass
+        return os.read(self.read_fd, 1)
+
+    def close(self):
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
+        if self._tmp_dir:
+            shutil.rmtree(self._tmp_dir)
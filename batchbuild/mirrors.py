@@ -0,0 +1,171 @@
+import json
+import os
+import pipes
+import re
+import subprocess
+import threading
+
+from batchbuilderror import BatchBuildError
+
+
+# Lists the mirrored urls, stored in the mirror dir
+MIRROR_INDEX_NAME = "mirrors.json"
+
+SUBMODULE_URL_RX = re.compile(r"^submodule\..*\.url\s+(.*)$")
+
+_mirror_sets = {}
+_mirror_sets_lock = threading.Lock()
+
+
+def get_mirror_set(mirror_dir):
+    """
+    Returns the MirrorSet for mirror_dir. MirrorSet instances are shared.
+    """
+    mirror_dir = os.path.abspath(os.path.expanduser(os.path.expandvars(mirror_dir)))
+    with _mirror_sets_lock:
+        if mirror_dir not in _mirror_sets:
+            _mirror_sets[mirror_dir] = MirrorSet(mirror_dir)
+        return _mirror_sets[mirror_dir]
+
+
+def resolve_url(base_url, url):
+    """
+    Resolves submodule url, which can be relative to the url of its parent
+    repository
+    """
+    if not url.startswith("./") and not url.startswith("../"):
+        return url
+    base = base_url.rstrip("/")
+    separator = "/"
+    for component in url.split("/"):
+        if component == "..":
+            idx = max(base.rfind("/"), base.rfind(":"))
+            if idx > 0:
+                separator = base[idx]
+                base = base[:idx]
+        elif component not in (".", ""):
+            base += separator + component
+            separator = "/"
+    return base
+
+
+class MirrorSet(object):
+    """
+    A dir of bare mirrors of git repositories, shared by all devos of the host.
+
+    Git commands of modules are redirected to the mirrors with
+    url.<mirror>.insteadOf options, so that they do not hit the network. The
+    mirrors themselves are updated by refresh().
+    """
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+        self._index_name = os.path.join(mirror_dir, MIRROR_INDEX_NAME)
+        self._lock = threading.Lock()
+        self._index = {}
+        if os.path.exists(self._index_name):
+            try:
+                with open(self._index_name) as fp:
+                    self._index = json.load(fp)
+            except ValueError:
+                pass
+
+    def get_mirror_path(self, url):
+        name = re.sub(r"[^\w.-]+", "_", url).strip("_")
+        if not name.endswith(".git"):
+            name += ".git"
+        return os.path.join(self.mirror_dir, name)
+
+    def get_git_args(self, url):
+        """
+        Returns a list of git arguments to redirect url and the urls of its
+        submodules to their mirrors
+        """
+        args = []
+        mirrored_urls, other_urls = self._list_urls(url)
+        for mirrored_url in mirrored_urls:
+            path = self.get_mirror_path(mirrored_url)
+            # Use a file:// url: git ignores --depth and --filter when cloning
+            # from a plain path
+            mirror_url = "file://" + os.path.abspath(path)
+            args.extend(["-c", "url.%s.insteadOf=%s" % (mirror_url, mirrored_url)])
+        # insteadOf matches url prefixes, the longest match winning: keep the
+        # urls which are not mirrored but start with a mirrored url, such as
+        # foo-extra for foo, as they are
+        for other_url in other_urls:
+            if any(other_url.startswith(x) for x in mirrored_urls):
+                args.extend(["-c", "url.%s.insteadOf=%s" % (other_url, other_url)])
+        return args
+
+    def get_git_options(self, url):
+        """
+        Same as get_git_args(), but returns a string for a shell command
+        """
+        return "".join(" " + pipes.quote(x) for x in self.get_git_args(url))
+
+    def refresh(self, url, runner, seen=None):
+        """
+        Create or update the mirror of url, and the mirrors of its submodules
+        """
+        if seen is None:
+            seen = set()
+        seen.add(url)
+        path = self.get_mirror_path(url)
+        if os.path.exists(path):
+            runner.run(path, "git remote update --prune")
+        else:
+            if not os.path.exists(self.mirror_dir):
+                os.makedirs(self.mirror_dir)
+            runner.run(self.mirror_dir, "git clone --mirror %s %s" % (url, path))
+
+        submodule_urls = self._read_submodule_urls(url, path)
+        with self._lock:
+            self._index[url] = {"submodules": submodule_urls}
+            self._save()
+
+        for submodule_url in submodule_urls:
+            if submodule_url not in seen:
+                self.refresh(submodule_url, runner, seen)
+
+    def _list_urls(self, url):
+        """
+        Returns a tuple (mirrored, others): the urls of url and its submodules
+        which are mirrored, and the ones which are not
+        """
+        mirrored = []
+        others = []
+        todo = [url]
+        with self._lock:
+            while todo:
+                url = todo.pop()
+                if url in mirrored or url in others:
+                    continue
+                if url not in self._index or not os.path.exists(self.get_mirror_path(url)):
+                    others.append(url)
+                    continue
+                mirrored.append(url)
+                todo.extend(self._index[url]["submodules"])
+        return mirrored, others
+
+    def _read_submodule_urls(self, url, path):
+        try:
+            with open(os.devnull, "w") as null:
+                output = subprocess.check_output(
+                    ["git", "config", "--blob", "HEAD:.gitmodules", "--get-regexp", r"^submodule\..*\.url$"],
+                    cwd=path, stderr=null)
+        except subprocess.CalledProcessError:
+            # No .gitmodules
+            return []
+        except OSError, exc:
+            raise BatchBuildError("Could not list submodules of %s: %s" % (url, exc))
+        urls = []
+        for line in output.splitlines():
+            match = SUBMODULE_URL_RX.match(line)
+            if match:
+                urls.append(resolve_url(url, match.group(1)))
+        return urls
+
+    def _save(self):
+        tmp_name = self._index_name + ".tmp"
+        with open(tmp_name, "w") as fp:
+            json.dump(self._index, fp, indent=2, sort_keys=True)
+        os.rename(tmp_name, self._index_name)
@@ -1,12 +1,72 @@
+import contextlib
+import json
 import logging
 import os
 import shutil
 
 import vcs
+from artifactcache import DEFAULT_MAX_SIZE, parse_size
+from batchbuilderror import BatchBuildError
+from compilercache import create_compiler_cache
+from installmanifest import InstallManifest, install_from_stage, read_cmake_manifest, uninstall
+from jobserver import parse_jobs_option, strip_jobs_option
+from runner import StepLimits
+from timingdb import parse_duration
+
+# Written in the build dir after a successful configure, records how the
+# build dir was configured
+CONFIGURE_STAMP_NAME = ".devo-batchbuild-configure"
+
+# Files created by configure commands, at least one of them must be there for
+# a build dir to be considered configured
+CONFIGURE_OUTPUT_NAMES = ("CMakeCache.txt", "config.status", "Makefile", "build.ninja")
+
+# Dir of the build dir where files are installed when install-mode is
+# incremental
+STAGE_DIR_NAME = ".devo-batchbuild-stage"
+
+INSTALL_MODES = ("direct", "incremental")
+
+# Steps which can be given a timeout with a "<step>-timeout" option
+TIMEOUT_STEPS = ("checkout", "switch-branch", "update", "configure", "build", "install")
+
+# Steps which talk to a server, and can be retried with a "<step>-retries"
+# option
+NETWORK_STEPS = ("checkout", "update")
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+def get_step_limits(config):
+    """
+    Returns the StepLimits defined by the options of the module config
+    """
+    timeouts = {}
+    for step in TIMEOUT_STEPS:
+        value = config.get(step + "-timeout")
+        if value:
+            timeouts[step] = parse_duration(value)
+    stall_timeout = config.get("stall-timeout")
+    if stall_timeout:
+        stall_timeout = parse_duration(stall_timeout)
+    retries = {}
+    for step in NETWORK_STEPS:
+        value = config.get(step + "-retries")
+        if value:
+            try:
+                retries[step] = int(value)
+            except ValueError:
+                raise BatchBuildError("Invalid %s-retries: %s" % (step, value))
+    return StepLimits(timeouts, stall_timeout or None, retries)
+
 
 class Module(object):
-    def __init__(self, config):
+    def __init__(self, config, jobserver=None):
         self.config = config
+        self.jobserver = jobserver
         self.name = self.config.flat_get("name")
         assert self.name is not None
 
@@ -37,53 +97,255 @@ class Module(object):
         else:
             raise Exception("Unknown repo-type: %s" % repo_type)
 
+        self.install_mode = self.config.get("install-mode", "direct")
+        if self.install_mode not in INSTALL_MODES:
+            raise BatchBuildError("Invalid install-mode: %s, must be 'direct' or 'incremental'"
+                                  % self.install_mode)
+
+        self.compiler_cache = create_compiler_cache(self)
+
     def has_checkout(self):
         return os.path.exists(self.src_dir)
 
     def checkout(self, runner):
         if not os.path.exists(self.base_dir):
             os.makedirs(self.base_dir)
+        runner.step = "checkout"
         self.vcs.checkout(runner)
 
     def switch_branch(self, runner):
+        runner.step = "switch-branch"
         self.vcs.switch_branch(runner)
 
     def update(self, runner):
+        runner.step = "update"
         self.vcs.update(runner)
 
+    def has_upstream_changes(self):
+        if not self.has_checkout():
+            return True
+        return self.vcs.has_upstream_changes()
+
+    def revision(self):
+        if not self.has_checkout():
+            return None
+        return self.vcs.revision()
+
     def refresh_build(self):
         if os.path.exists(self.build_dir):
             logging.info("Removing dir '%s'" % self.build_dir)
             shutil.rmtree(self.build_dir)
 
-    def configure(self, runner):
+    def configure(self, runner, force=False):
+        """
+        Configure the build dir. Unless force is True, nothing is done if the
+        build dir has already been configured with the same command.
+        """
         if not os.path.exists(self.build_dir):
             os.makedirs(self.build_dir)
         configure = self.config.get("configure", "devo_cmake " + self.src_dir)
         opts = self.config.get("configure-options", "")
         extra_opts = self.config.get("configure-extra-options", "")
-        runner.run(self.build_dir, configure + " " + opts + " " + extra_opts, env=self._getenv())
+        command = configure + " " + opts + " " + extra_opts
+        if self.compiler_cache and "cmake" in configure:
+            command += " " + self.compiler_cache.get_cmake_options()
+        env = self._getenv()
+
+        stamp = {
+            "command": command.strip(),
+            "expanded-command": os.path.expandvars(command.strip()),
+            "options": [configure, opts, extra_opts],
+            "env": dict((x, env[x]) for x in ("DEVO_SOURCE_DIR", "DEVO_BUILD_DIR")),
+        }
+        stamp_name = os.path.join(self.build_dir, CONFIGURE_STAMP_NAME)
+        if not force and self._is_configured(stamp_name, stamp):
+            runner.report("configure", "cached")
+            return
+
+        if os.path.exists(stamp_name):
+            os.unlink(stamp_name)
+        runner.step = "configure"
+        runner.run(self.build_dir, command, env=env)
+        with open(stamp_name, "w") as fp:
+            json.dump(stamp, fp, indent=2, sort_keys=True)
+
+    def _is_configured(self, stamp_name, stamp):
+        if not any(os.path.exists(os.path.join(self.build_dir, x)) for x in CONFIGURE_OUTPUT_NAMES):
+            return False
+        try:
+            with open(stamp_name) as fp:
+                return json.load(fp) == stamp
+        except (IOError, ValueError):
+            return False
 
     def build(self, runner):
         if not os.path.exists(self.build_dir):
-            self.configure()
+            self.configure(runner)
         build = self.config.get("build", "make")
         if not build:
             return
         opts = self.config.get("build-options", "")
+        if self.jobserver:
+            opts = strip_jobs_option(opts)
+            if self._get_own_jobs() is not None:
+                # The module caps its number of jobs: run them outside of the
+                # jobserver, within the total number of jobs
+                opts = (opts + " -j%d" % self._get_reserved_jobs()).strip()
+            # Otherwise let the jobserver decide how many jobs to run
         extra_opts = self.config.get("build-extra-options", "")
-        runner.run(self.build_dir, build + " " + opts + " " + extra_opts, env=self._getenv(), report_progress=True)
+        if self.compiler_cache:
+            self.compiler_cache.start_stats()
+        runner.step = "build"
+        with self._reserve_jobs():
+            runner.run(self.build_dir, build + " " + opts + " " + extra_opts, env=self._getenv(), report_progress=True)
 
-    def install(self, runner):
+    def _get_own_jobs(self):
+        """
+        Returns the number of jobs set by a -jN option in the build-options of
+        the module itself, or None. Options inherited from the global section
+        or _base.yaml do not count.
+        """
+        opts = self.config.flat_get("build-options")
+        if opts is None:
+            return None
+        return parse_jobs_option(opts)
+
+    def _get_reserved_jobs(self):
+        """
+        Returns the number of jobserver tokens held by a make of the module:
+        the implicit token of make, or the number of jobs set by the module
+        own -jN option, at most the total number of jobs
+        """
+        own_jobs = self._get_own_jobs()
+        if own_jobs is None:
+            return 1
+        total_jobs = self.jobserver.total_jobs
+        return min(own_jobs or total_jobs, total_jobs)
+
+    def _reserve_jobs(self):
+        """
+        Returns a context holding the jobserver tokens used by a make of the
+        module while it runs, see _get_reserved_jobs()
+        """
+        if not self.jobserver:
+            return _null_context()
+        return self.jobserver.reserve(self._get_reserved_jobs())
+
+    def _get_install_command(self):
         install = self.config.get("install", "make install/fast")
         if not install:
-            return
+            return None
         opts = self.config.get("install-options", "")
         extra_opts = self.config.get("install-extra-options", "")
-        runner.run(self.build_dir, install + " " + opts + " " + extra_opts, env=self._getenv())
+        return install + " " + opts + " " + extra_opts
+
+    def install(self, runner):
+        command = self._get_install_command()
+        if not command:
+            return
+        runner.step = "install"
+        if self.install_mode == "incremental":
+            self._install_incrementally(runner)
+        else:
+            with self._reserve_jobs():
+                runner.run(self.build_dir, command, env=self._getenv())
+            manifest = InstallManifest(self.name)
+            if read_cmake_manifest(self.build_dir, manifest):
+                manifest.save()
+
+    def uninstall(self, runner):
+        """
+        Remove the files installed by the last install of the module. The
+        configure stamp is removed too, so that the next build starts from
+        scratch.
+        """
+        stamp_name = os.path.join(self.build_dir, CONFIGURE_STAMP_NAME)
+        if os.path.exists(stamp_name):
+            os.unlink(stamp_name)
+        manifest = InstallManifest(self.name)
+        if not manifest.exists():
+            runner.report("uninstall", "no install manifest, nothing to remove")
+            return
+        removed = uninstall(manifest)
+        runner.report("uninstall", "%d files removed" % removed)
+
+    def uses_artifact_cache(self):
+        return bool(self.config.get("artifact-cache", False))
+
+    def restore_artifacts(self, runner, artifact_cache, key):
+        """
+        Install the snapshot stored in artifact_cache for key instead of
+        building the module. Returns False if there is no such snapshot.
+        """
+        manifest = InstallManifest(self.name)
+        counts = artifact_cache.restore(key, manifest)
+        if counts is None:
+            return False
+        runner.report("install", "restored from artifact cache, %d files changed, %d unchanged, %d removed"
+                      % counts)
+        return True
+
+    def store_artifacts(self, runner, artifact_cache, key):
+        """
+        Store a snapshot of the files installed by the module in
+        artifact_cache for key
+        """
+        manifest = InstallManifest(self.name)
+        if not manifest.files:
+            runner.report("install", "no install manifest, not stored in artifact cache")
+            return
+        max_size = parse_size(self.config.get("artifact-cache-size", DEFAULT_MAX_SIZE),
+                              "artifact-cache-size")
+        artifact_cache.store(key, self.name, manifest, max_size)
+
+    def install_to_stage(self, runner):
+        """
+        Run the install command with DESTDIR pointing to a staging dir,
+        returns the staging dir, or None if the module has no install command.
+        The caller is responsible for removing the staging dir.
+        """
+        command = self._get_install_command()
+        if not command:
+            return None
+        runner.step = "install"
+        stage_dir = os.path.join(self.build_dir, STAGE_DIR_NAME)
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+        env = self._getenv()
+        env["DESTDIR"] = stage_dir
+        with self._reserve_jobs():
+            runner.run(self.build_dir, command, env=env)
+        if not os.path.exists(stage_dir):
+            raise BatchBuildError("Nothing installed in %s, does '%s' support DESTDIR?"
+                                  % (stage_dir, command.strip()))
+        return stage_dir
+
+    def _install_incrementally(self, runner):
+        """
+        Install in a staging dir, then only copy the files which changed, so
+        that unchanged files keep their modification time
+        """
+        stage_dir = self.install_to_stage(runner)
+        manifest = InstallManifest(self.name)
+        changed, unchanged, removed = install_from_stage(stage_dir, manifest)
+        shutil.rmtree(stage_dir)
+        runner.report("install", "%d files changed, %d unchanged, %d removed"
+                      % (changed, unchanged, removed))
+
+    def get_compiler_cache_stats(self):
+        """
+        Returns a tuple (hits, misses) for the last build, or None
+        """
+        if not self.compiler_cache:
+            return None
+        return self.compiler_cache.get_stats()
 
     def _getenv(self):
         env = dict(os.environ)
         env["DEVO_SOURCE_DIR"] = os.path.join(env["DEVO_SOURCE_BASE_DIR"], self.name)
         env["DEVO_BUILD_DIR"] = os.path.join(env["DEVO_BUILD_BASE_DIR"], self.name)
+        if self.jobserver and self._get_own_jobs() is None:
+            self.jobserver.update_env(env)
+        if self.compiler_cache:
+            self.compiler_cache.update_env(env)
         return env
@@ -1,18 +1,184 @@
-import dbus
+import atexit
+import logging
+import os
+import Queue
+import threading
+import time
+
+from batchbuilderror import BatchBuildError
+
+# How long to wait for more notifications before sending, so that bursts are
+# collapsed into a single notification
+BATCH_DELAY = 1.0
+
+# Icons used for a collapsed notification, the first one used by one of the
+# notifications wins
+SUMMARY_ICONS = ("dialog-error", "dialog-warning")
+
+_notifier = None
+
+
+class NullBackend(object):
+    def send(self, title, body, icon):
+        pass
+
+
+class FileBackend(object):
+    """
+    Appends notifications to a file, one per line
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def send(self, title, body, icon):
+        with open(self.file_name, "a") as fp:
+            fp.write("%s\t%s\t%s\t%s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), icon, title,
+                                           body.replace("\n", " | ")))
+
+
+class DBusBackend(object):
+    """
+    Sends notifications to the desktop notification daemon. The bus connection
+    is opened on first use and reused. If it fails, notifications are dropped
+    instead of waiting for D-Bus timeouts again.
+    """
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self._iface = None
+        self._broken = False
+
+    def send(self, title, body, icon):
+        if self._broken:
+            return
+        try:
+            # Imported here so that dbus is only loaded if notifications are
+            # sent
+            import dbus
+        except ImportError:
+            logging.warning("python-dbus is not installed, notifications are disabled")
+            self._broken = True
+            return
+        try:
+            if self._iface is None:
+                bus = dbus.SessionBus()
+                obj = bus.get_object('org.freedesktop.Notifications', '/org/freedesktop/Notifications')
+                self._iface = dbus.Interface(obj, dbus_interface = 'org.freedesktop.Notifications')
+            self._iface.Notify(self.app_name,
+                0,
+                icon,
+                title,
+                body,
+                [], # actions
+                {}, # hints
+                -1, # timeout
+                )
+        except dbus.exceptions.DBusException:
+            self._broken = True
+
+
+def create_backend(spec, app_name="nanotify"):
+    """
+    Returns the backend described by spec:
+    - "auto": "dbus" if there is a D-Bus session, "none" otherwise
+    - "dbus": desktop notifications
+    - "none": drop notifications
+    - "file:<path>": append notifications to <path>
+    """
+    if spec == "auto":
+        spec = "dbus" if os.environ.get("DBUS_SESSION_BUS_ADDRESS") else "none"
+    if spec == "dbus":
+        return DBusBackend(app_name)
+    elif spec == "none":
+        return NullBackend()
+    elif spec.startswith("file:"):
+        return FileBackend(spec[len("file:"):])
+    else:
+        raise BatchBuildError("Unknown notification backend: %s" % spec)
+
+
+class Notifier(object):
+    """
+    Sends notifications from a background thread, so that callers never block
+    on the backend. Notifications arriving within BATCH_DELAY of each other
+    are collapsed into a single one titled summary_title.
+    """
+    def __init__(self, backend, summary_title, delay=BATCH_DELAY):
+        self.backend = backend
+        self.summary_title = summary_title
+        self.delay = delay
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def notify(self, title, body, icon=""):
+        self._queue.put((title, body, icon))
+
+    def close(self, timeout=5):
+        """
+        Send pending notifications and stop the thread
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + self.delay
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._send(batch)
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            title, body, icon = batch[0]
+        else:
+            title = "%s: %d notifications" % (self.summary_title, len(batch))
+            body = "\n".join("%s: %s" % (x[0], x[1]) for x in batch)
+            icons = [x[2] for x in batch]
+            icon = next((x for x in SUMMARY_ICONS if x in icons), icons[-1])
+        try:
+            self.backend.send(title, body, icon)
+        except Exception, exc:
+            # Do not let a failing backend stop the thread, later
+            # notifications would pile up in the queue
+            logging.warning("Could not send notification: %s", exc)
+
+
+def setup(spec="auto", app_name="nanotify"):
+    """
+    Sets the backend used by notify(). Pending notifications are sent at exit.
+    """
+    global _notifier
+    if _notifier:
+        _notifier.close()
+    else:
+        atexit.register(shutdown)
+    _notifier = Notifier(create_backend(spec, app_name), app_name)
+
+
+def shutdown():
+    global _notifier
+    if _notifier:
+        _notifier.close()
+        _notifier = None
+
 
 def notify(title, body, icon=""):
-    try:
-        bus = dbus.SessionBus()
-        obj = bus.get_object('org.freedesktop.Notifications', '/org/freedesktop/Notifications')
-        iface = dbus.Interface(obj, dbus_interface = 'org.freedesktop.Notifications')
-        iface.Notify("nanotify",
-            0,
-            icon,
-            title,
-            body,
-            [], # actions
-            {}, # hints
-            -1, # timeout
-            )
-    except dbus.exceptions.DBusException:
-        return
+    if _notifier is None:
+        setup()
+    _notifier.notify(title, body, icon)
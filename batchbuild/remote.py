@@ -0,0 +1,358 @@
+"""
+Build modules on workers.
+
+A worker is a `devo-batchbuild --worker` process, started by the coordinator
+with a command: either a local process or `ssh <host> devo-batchbuild
+--worker`. They exchange json messages, one per line, on the worker stdin and
+stdout.
+
+Coordinator to worker:
+- hello: "env" contains the DEVO_* variables of the coordinator, used by the
+  worker for the variables it does not define itself
+- update: update or checkout the source of the module whose flattened config
+  is "config". The result contains the "revision" of the source.
+- build: install the "upstream" modules files, then configure, build and
+  install the module into a staging dir. The result contains the installed
+  "files".
+
+Worker to coordinator:
+- output: "data" is output of the running command
+- step-start, progress, step: the running step, its progress and its timing
+- result: "ok" is False if the request failed, "error" tells why and
+  "timed-out-step" is set if it failed because a step took too long
+
+Files are sent as base64 encoded tar.gz archives of paths relative to
+DEVO_PREFIX, see installmanifest.pack_files().
+"""
+import base64
+import collections
+import json
+import os
+import Queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import flog
+from batchbuilderror import BatchBuildError, StepTimeoutError
+from cascadedconfig import CascadedConfig
+from installmanifest import InstallManifest, install_from_stage, install_packed_files, pack_files
+from module import Module, get_step_limits
+from runner import Runner
+from timingdb import format_duration
+
+# Resource usage of a step run by a worker, with the fields of
+# resource.getrusage() results used by TimingDb
+RUsage = collections.namedtuple("RUsage", "ru_maxrss ru_utime ru_stime")
+
+
+class Channel(object):
+    """
+    Sends and receives json messages, one per line
+    """
+    def __init__(self, input_fp, output_fp):
+        self._input_fp = input_fp
+        self._output_fp = output_fp
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        line = json.dumps(msg) + "\n"
+        with self._lock:
+            self._output_fp.write(line)
+            self._output_fp.flush()
+
+    def receive(self):
+        """
+        Returns the next message, or None if the other side is gone
+        """
+        line = self._input_fp.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+
+def encode_output(data):
+    # Command output is not necessarily valid utf-8, latin-1 maps all bytes
+    return data.decode("latin-1")
+
+
+def decode_output(text):
+    return text.encode("latin-1")
+
+
+# Worker side
+
+class ChannelLog(object):
+    """
+    A log file sending what is written to it to the coordinator
+    """
+    def __init__(self, channel):
+        self._channel = channel
+
+    def write(self, data):
+        self._channel.send({"type": "output", "data": encode_output(data)})
+
+    def flush(self):
+        pass
+
+
+class ChannelStatus(object):
+    """
+    A dashboard.ModuleStatus forwarding what the Runner reports to the
+    coordinator
+    """
+    def __init__(self, channel):
+        self._channel = channel
+
+    def start_step(self, step):
+        self._channel.send({"type": "step-start", "step": step})
+
+    def set_progress(self, progress):
+        self._channel.send({"type": "progress", "progress": progress})
+
+    def end_step(self):
+        pass
+
+
+class WorkerAgent(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def run(self):
+        while True:
+            msg = self.channel.receive()
+            if msg is None:
+                return 0
+            try:
+                handler = getattr(self, "_handle_" + msg["type"].replace("-", "_"))
+                result = handler(msg) or {}
+                result["ok"] = True
+            except StepTimeoutError, exc:
+                result = {"ok": False, "error": str(exc), "timed-out-step": exc.step}
+            except BatchBuildError, exc:
+                result = {"ok": False, "error": str(exc)}
+            except Exception, exc:
+                # Report unexpected errors too, the coordinator would
+                # otherwise see the worker exit without knowing why
+                result = {"ok": False, "error": "%s: %s" % (exc.__class__.__name__, exc)}
+            result["type"] = "result"
+            self.channel.send(result)
+
+    def _create_runner(self, config):
+        def record_step(step, start_time, duration, exit_code, rusage):
+            self.channel.send({
+                "type": "step",
+                "step": step,
+                "start": start_time,
+                "duration": duration,
+                "exit_code": exit_code,
+                "rusage": [rusage.ru_maxrss, rusage.ru_utime, rusage.ru_stime] if rusage else None,
+            })
+        return Runner(ChannelLog(self.channel), False, record_step=record_step,
+                      status=ChannelStatus(self.channel), limits=get_step_limits(config))
+
+    def _handle_hello(self, msg):
+        for key, value in msg["env"].items():
+            os.environ.setdefault(key, value.encode("utf-8"))
+
+    def _handle_update(self, msg):
+        config = CascadedConfig(msg["config"])
+        module = Module(config)
+        runner = self._create_runner(config)
+        if msg["switch-branch"] and module.has_checkout():
+            module.switch_branch(runner)
+        if not msg["no-src"]:
+            if module.has_checkout():
+                module.update(runner)
+            else:
+                module.checkout(runner)
+        return {"revision": module.revision()}
+
+    def _handle_build(self, msg):
+        prefix = os.environ["DEVO_PREFIX"]
+        for upstream in msg["upstream"]:
+            install_packed_files(base64.b64decode(upstream["files"]), prefix,
+                                 InstallManifest(upstream["name"]))
+
+        config = CascadedConfig(msg["config"])
+        module = Module(config)
+        runner = self._create_runner(config)
+        if msg["refresh-build"]:
+            module.refresh_build()
+        module.configure(runner, force=msg["reconfigure"])
+        module.build(runner)
+        stage_dir = module.install_to_stage(runner)
+        manifest = InstallManifest(module.name)
+        if stage_dir:
+            # Install on the worker too, for the modules built there which
+            # depend on this one
+            install_from_stage(stage_dir, manifest)
+            shutil.rmtree(stage_dir)
+        return {"files": base64.b64encode(pack_files(manifest.files, prefix))}
+
+
+def run_worker():
+    """
+    Serve requests on stdin/stdout until stdin is closed
+    """
+    # Keep stdout for messages, and send what would be printed there to
+    # /dev/null
+    output_fp = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    sys.stdout = open(os.devnull, "w")
+    return WorkerAgent(Channel(sys.stdin, output_fp)).run()
+
+
+# Coordinator side
+
+def get_worker_command(spec, script_name):
+    """
+    Returns a tuple (command, env) to start the worker described by spec:
+    - "local": a local process
+    - "local:<dir>": a local process using <dir>/src, <dir>/build and
+      <dir>/prefix instead of the devo dirs, to stand in for a remote host
+    - "ssh:<host>": devo-batchbuild on host, through ssh
+    """
+    if spec == "local" or spec.startswith("local:"):
+        env = dict(os.environ)
+        if spec.startswith("local:"):
+            root = os.path.abspath(spec[len("local:"):])
+            env["DEVO_SOURCE_BASE_DIR"] = os.path.join(root, "src")
+            env["DEVO_BUILD_BASE_DIR"] = os.path.join(root, "build")
+            env["DEVO_PREFIX"] = os.path.join(root, "prefix")
+        return [sys.executable, script_name, "--worker"], env
+    elif spec.startswith("ssh:"):
+        return ["ssh", "-T", spec[len("ssh:"):], "devo-batchbuild", "--worker"], None
+    else:
+        raise BatchBuildError("Invalid worker: %s" % spec)
+
+
+class Worker(object):
+    def __init__(self, spec, script_name):
+        self.name = spec
+        command, env = get_worker_command(spec, script_name)
+        try:
+            self.process = subprocess.Popen(command, env=env, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        except OSError, exc:
+            raise BatchBuildError("Could not start worker %s: %s" % (spec, exc))
+        self.channel = Channel(self.process.stdout, self.process.stdin)
+        # False once the connection to the worker is lost
+        self.alive = True
+        # name => fingerprint of the modules whose files the worker has
+        self.modules = {}
+        env = dict((k, v) for k, v in os.environ.items() if k.startswith("DEVO_"))
+        try:
+            self.request({"type": "hello", "env": env})
+        except BatchBuildError:
+            self.close()
+            raise
+
+    def request(self, msg, handler=None):
+        """
+        Send request msg and wait for its result. Other messages are passed to
+        handler. Raises BatchBuildError if the request failed.
+        """
+        if not self.alive:
+            raise BatchBuildError("Worker %s exited" % self.name)
+        try:
+            self.channel.send(msg)
+        except IOError, exc:
+            self.alive = False
+            raise BatchBuildError("Could not send request to worker %s: %s" % (self.name, exc))
+        while True:
+            try:
+                reply = self.channel.receive()
+            except (IOError, ValueError), exc:
+                self.alive = False
+                raise BatchBuildError("Could not read reply of worker %s: %s" % (self.name, exc))
+            if reply is None:
+                self.alive = False
+                raise BatchBuildError("Worker %s exited" % self.name)
+            if reply["type"] == "result":
+                if "timed-out-step" in reply:
+                    raise StepTimeoutError(reply["error"], reply["timed-out-step"])
+                if not reply["ok"]:
+                    raise BatchBuildError(reply["error"])
+                return reply
+            if handler:
+                handler(reply)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            # Already gone
+            pass
+        self.process.wait()
+
+
+class MessageHandler(object):
+    """
+    Handles the messages a worker sends while building module name: output
+    goes to log, steps are reported to status and record_step, and printed
+    """
+    def __init__(self, name, worker, log, status, record_step):
+        self.label = "%s@%s" % (name, worker.name)
+        self.log = log
+        self.status = status
+        self.record_step = record_step
+
+    def __call__(self, msg):
+        if msg["type"] == "output":
+            self.log.write(decode_output(msg["data"]))
+        elif msg["type"] == "step-start":
+            self.status.start_step(msg["step"])
+            flog.p("%s %s: %s", time.strftime("%H:%M"), self.label, msg["step"])
+        elif msg["type"] == "progress":
+            self.status.set_progress(msg["progress"])
+        elif msg["type"] == "step":
+            self.status.end_step()
+            rusage = RUsage(*msg["rusage"]) if msg["rusage"] else None
+            self.record_step(msg["step"], msg["start"], msg["duration"], msg["exit_code"], rusage)
+            flog.p("%s %s: %s - took %s", time.strftime("%H:%M"), self.label, msg["step"],
+                   format_duration(msg["duration"]))
+
+
+class WorkerPool(object):
+    """
+    Hands out workers to the threads building modules, so that each module
+    is built on whichever worker is free. Workers whose connection is lost
+    are not handed out again.
+    """
+    def __init__(self, specs, script_name):
+        self.workers = []
+        try:
+            for spec in specs:
+                self.workers.append(Worker(spec, script_name))
+        except BatchBuildError:
+            # Do not leave the workers already started running
+            self.close()
+            raise
+        self._free = Queue.Queue()
+        for worker in self.workers:
+            self._free.put(worker)
+
+    def acquire(self):
+        """
+        Returns a free worker, waiting for one if needed. Raises
+        BatchBuildError if all workers are gone.
+        """
+        while True:
+            if not any(x.alive for x in self.workers):
+                raise BatchBuildError("All workers exited")
+            try:
+                return self._free.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def release(self, worker):
+        if worker.alive:
+            self._free.put(worker)
+        else:
+            flog.error("Lost worker %s, not using it anymore", worker.name)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
@@ -0,0 +1,100 @@
+import flog
+from targetprofile import COMPILE, LINK
+from timingdb import format_duration, get_durations_by_run
+
+# Number of modules listed in the report sections
+MODULE_COUNT = 10
+
+# Number of targets listed in the target report sections
+TARGET_COUNT = 20
+
+STEPS = ("checkout", "switch-branch", "update", "configure", "build", "install")
+
+
+def sum_steps(durations):
+    """
+    Turns a dict of module => dict of step => duration into a dict of
+    module => duration
+    """
+    return dict((name, sum(steps.values())) for name, steps in durations.items())
+
+
+def print_report(timing_db, project, graph, run_count):
+    """
+    Print where time was spent during the last builds of project. If graph is
+    set, it is used to find the critical path.
+    """
+    runs = get_durations_by_run(timing_db.read(project))
+    if not runs:
+        flog.error("No build timings recorded for %s", project)
+        return 1
+    runs = runs[-run_count:]
+
+    last_run, last_durations = runs[-1]
+    totals = sum_steps(last_durations)
+    slowest = sorted(totals, key=lambda x: totals[x], reverse=True)[:MODULE_COUNT]
+
+    flog.h1("Slowest modules of last run (%s)", last_run)
+    for name in slowest:
+        steps = last_durations[name]
+        details = ", ".join("%s %s" % (x, format_duration(steps[x]))
+                            for x in STEPS if x in steps)
+        flog.li("%s: %s (%s)", name, format_duration(totals[name]), details)
+
+    flog.h1("Trend over last %d runs", len(runs))
+    run_totals = [sum_steps(x) for _, x in runs]
+    for run_id, durations in zip([x for x, _ in runs], run_totals):
+        flog.li("%s: %s for %d modules", run_id, format_duration(sum(durations.values())),
+                len(durations))
+    for name in slowest:
+        trend = [format_duration(x[name]) if name in x else "-" for x in run_totals]
+        flog.li("%s: %s", name, " | ".join(trend))
+
+    if graph:
+        flog.h1("Critical path of last run")
+        duration, names = graph.critical_path(totals)
+        for name in names:
+            flog.li("%s: %s", name, format_duration(totals.get(name, 0)))
+        flog.p("Total: %s", format_duration(duration))
+    return 0
+
+
+def format_target_duration(duration):
+    # Most targets take seconds, keep the tenths
+    if duration < 60:
+        return "%.1fs" % duration
+    return format_duration(duration)
+
+
+def print_target_report(target_db, project):
+    """
+    Print the slowest targets of the last build of project done with
+    --profile. Returns False if there is none.
+    """
+    entries = list(target_db.read(project))
+    if not entries:
+        return False
+    last_run = entries[-1]["run"]
+    entries = [x for x in entries if x["run"] == last_run]
+    entries.sort(key=lambda x: x["duration"], reverse=True)
+
+    for kind, title in (COMPILE, "compiled files"), (LINK, "links"):
+        lst = [x for x in entries if x["kind"] == kind]
+        if not lst:
+            continue
+        flog.h1("Slowest %s of last profiled run (%s)", title, last_run)
+        for entry in lst[:TARGET_COUNT]:
+            flog.li("%s %s: %s", format_target_duration(entry["duration"]), entry["module"],
+                    entry["target"])
+            if entry["trace"]:
+                flog.li("    trace: %s", entry["trace"])
+        total = sum(x["duration"] for x in lst)
+        flog.p("Total: %s for %d targets", format_target_duration(total), len(lst))
+
+    flog.h1("Time spent on targets per module")
+    totals = {}
+    for entry in entries:
+        totals[entry["module"]] = totals.get(entry["module"], 0) + entry["duration"]
+    for name in sorted(totals, key=lambda x: totals[x], reverse=True)[:MODULE_COUNT]:
+        flog.li("%s: %s", name, format_target_duration(totals[name]))
+    return True
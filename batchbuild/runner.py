@@ -1,44 +1,136 @@
+import contextlib
+import errno
+import os
 import re
+import select
+import signal
 import subprocess
 import sys
 import time
 
-from batchbuilderror import BatchBuildError
+import flog
+from batchbuilderror import BatchBuildError, StepTimeoutError
+from timingdb import format_duration
 
 
 PERCENT_RX = re.compile(r"\[ *(\d+%)\]")
 
+NINJA_RX = re.compile(r"^\[(\d+)/(\d+)\] ")
 
-def format_duration(duration):
-    hours, rest = divmod(duration, 3600)
-    minutes, seconds = divmod(rest, 60)
-    lst = []
-    if hours > 0:
-        lst.append("%dh" % hours)
-    if minutes > 0 or hours > 0:
-        lst.append("%dm" % minutes)
-    lst.append("%ds" % seconds)
-    return " ".join(lst)
+# Progress reached when cmake prints these lines while configuring
+CMAKE_PHASES = (("-- Configuring done", 0.8), ("-- Generating done", 0.95))
 
+# Size of the chunks read from command output
+READ_SIZE = 64 * 1024
 
-def extract_progress(line):
+# Minimum delay between two flushes of the log file, in seconds
+FLUSH_INTERVAL = 1.0
+
+# Minimum delay between two progress updates, in seconds
+PROGRESS_INTERVAL = 0.2
+
+# Number of lines at the end of an output chunk to look for progress in
+PROGRESS_LINES = 4
+
+# Delay between SIGTERM and SIGKILL when killing a command which timed out, in
+# seconds
+KILL_DELAY = 10.0
+
+# Delay before the first retry of a failed command, in seconds. It doubles
+# with each retry.
+RETRY_DELAY = 10.0
+
+
+def parse_progress(line):
+    """
+    Returns the progress reported by a line of make, ninja or cmake output, as
+    a number between 0 and 1, or None
+    """
     match = PERCENT_RX.search(line)
     if match:
-        return match.group(1)
-    else:
+        return int(match.group(1)[:-1]) / 100.
+    match = NINJA_RX.match(line)
+    if match:
+        done, total = int(match.group(1)), int(match.group(2))
+        return float(done) / total if total else None
+    for prefix, progress in CMAKE_PHASES:
+        if line.startswith(prefix):
+            return progress
+    return None
+
+
+def extract_progress(line):
+    progress = parse_progress(line)
+    if progress is None:
         return None
+    return "%d%%" % (progress * 100)
+
+
+class StepLimits(object):
+    """
+    Limits applied to the commands run for each step:
+    - timeouts: step => maximum duration of a command, in seconds
+    - stall_timeout: maximum time a command can run without printing
+      anything, in seconds, or None
+    - retries: step => number of times a failed command is run again
+    """
+    def __init__(self, timeouts=None, stall_timeout=None, retries=None):
+        self.timeouts = timeouts or {}
+        self.stall_timeout = stall_timeout
+        self.retries = retries or {}
 
 
 class Runner(object):
-    def __init__(self, log_file, verbose):
+    """
+    Runs commands, logging their output to log_file.
+
+    If prefix is set, the runner is used alongside other runners: each line
+    printed to stdout starts with prefix and no progress is reported.
+
+    If record_step is set, it is called after each command with the current
+    step, the start time, duration, exit code and resource usage of the
+    command.
+
+    If status is set, it is a dashboard.ModuleStatus, kept informed of the
+    running step and of its progress.
+
+    If limits is set, it is a StepLimits: commands running for too long are
+    killed, with all their children, and failed commands are retried.
+    """
+    def __init__(self, log_file, verbose, prefix=None, record_step=None, status=None,
+                 limits=None):
         self.log_file = log_file
         self.verbose = verbose
+        self.prefix = prefix
+        self.record_step = record_step
+        self.status = status
+        self.limits = limits or StepLimits()
+        self.step = "command"
+        self._captured = None
 
     def run(self, cwd, command, env=None, report_progress=False):
+        retries = self.limits.retries.get(self.step, 0)
+        delay = RETRY_DELAY
+        while True:
+            try:
+                self._run(cwd, command, env, report_progress)
+                return
+            except BatchBuildError, exc:
+                if retries == 0:
+                    raise
+            self.report(self.step, "%s, retrying in %s" % (exc, format_duration(delay)))
+            time.sleep(delay)
+            retries -= 1
+            delay *= 2
+
+    def _run(self, cwd, command, env, report_progress):
         command = command.strip()
         stamp = time.strftime("%H:%M")
         self._log_msg = "%s %s" % (stamp, command)
-        if self.verbose:
+        if self.prefix:
+            self._log_msg = "%s %s: %s" % (stamp, self.prefix, command)
+            flog.p("%s", self._log_msg)
+        elif self.verbose:
             print self._log_msg
         else:
             sys.stdout.write(self._log_msg)
@@ -48,39 +140,190 @@ class Runner(object):
         self.log_file.flush()
 
         start_time = time.time()
+        if self.status:
+            self.status.start_step(self.step)
+        self._last_flush = start_time
+        self._last_progress = 0
+        self._partial_line = ""
+        ret = None
+        rusage = None
+        self._timeout = self.limits.timeouts.get(self.step)
+        self._timeout_reason = None
+        # Commands which may have to be killed get their own process group, so
+        # that their children can be killed with them
+        use_group = bool(self._timeout or self.limits.stall_timeout)
         try:
-            process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-            while True:
-                out = process.stdout.readline()
-                self._log_output(out, report_progress)
-                process.poll()
-                ret = process.returncode
-                if ret is not None:
-                    if ret != 0:
-                        raise BatchBuildError("Command '%s' failed with exit code %d" % (command, ret))
-                    else:
-                        return
+            process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True,
+                                       preexec_fn=os.setpgrp if use_group else None)
+            try:
+                self._pump_output(process, report_progress, start_time)
+                ret, rusage = self._wait(process)
+            except BaseException:
+                if use_group:
+                    self._kill(process, signal.SIGKILL)
+                raise
+            if self._timeout_reason:
+                self.log_file.write("devo-batchbuild: %s\n" % self._timeout_reason)
+                raise StepTimeoutError("Command '%s' %s" % (command, self._timeout_reason), self.step)
+            if ret != 0:
+                raise BatchBuildError("Command '%s' failed with exit code %d" % (command, ret))
         finally:
+            self._flush_output()
+            if self.status:
+                self.status.end_step()
             duration = time.time() - start_time
+            if self.record_step and ret is not None:
+                self.record_step(self.step, start_time, duration, ret, rusage)
             txt = "took %s" % format_duration(duration)
-            if self.verbose:
+            if self.prefix:
+                flog.p("%s - %s", self._log_msg, txt)
+            elif self.verbose:
                 print txt
             else:
                 print " - " + txt
 
+    @contextlib.contextmanager
+    def capture_output(self, chunks):
+        """
+        Append the output of the commands run within the block to the list
+        chunks, in addition to logging it
+        """
+        self._captured = chunks
+        try:
+            yield
+        finally:
+            self._captured = None
+
+    def report(self, step, message):
+        """
+        Report a message about step, done without running a command
+        """
+        stamp = time.strftime("%H:%M")
+        if self.prefix:
+            flog.p("%s %s: %s: %s", stamp, self.prefix, step, message)
+        else:
+            flog.p("%s %s: %s", stamp, step, message)
+        self.log_file.write("devo-batchbuild: %s: %s\n" % (step, message))
+        self.log_file.flush()
+
+    def _wait(self, process):
+        """
+        Wait for process to finish, returns its exit code and its resource
+        usage, including the one of its children
+        """
+        while True:
+            try:
+                _, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError, exc:
+                if exc.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return process.returncode, rusage
+
+    def _pump_output(self, process, report_progress, start_time):
+        """
+        Read process output in large chunks until the pipe is closed, so that
+        no output is lost when the process exits. Kill the process if it
+        exceeds the limits of the step.
+        """
+        fd = process.stdout.fileno()
+        last_output_time = start_time
+        kill_time = None
+        try:
+            while True:
+                ready, _, _ = select.select([fd], [], [], FLUSH_INTERVAL)
+                now = time.time()
+                if ready:
+                    out = os.read(fd, READ_SIZE)
+                    if not out:
+                        return
+                    last_output_time = now
+                    self._log_output(out, report_progress)
+                if now - self._last_flush >= FLUSH_INTERVAL:
+                    self._flush_output()
+
+                if kill_time is None:
+                    self._timeout_reason = self._check_limits(now - start_time,
+                                                              now - last_output_time)
+                    if self._timeout_reason:
+                        self._kill(process, signal.SIGTERM)
+                        kill_time = now
+                elif now - kill_time >= KILL_DELAY:
+                    self._kill(process, signal.SIGKILL)
+                    # A child which left the process group may keep the pipe
+                    # open, do not wait for it
+                    return
+        finally:
+            process.stdout.close()
+
+    def _check_limits(self, duration, inactivity):
+        """
+        Returns why the running command must be killed, or None
+        """
+        if self._timeout and duration >= self._timeout:
+            return "timed out after %s" % format_duration(self._timeout)
+        stall_timeout = self.limits.stall_timeout
+        if stall_timeout and inactivity >= stall_timeout:
+            return "printed nothing for %s" % format_duration(stall_timeout)
+        return None
+
+    def _kill(self, process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError, exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def _flush_output(self):
+        self.log_file.flush()
+        self._last_flush = time.time()
+        if self.verbose and self.prefix and self._partial_line:
+            self._write_prefixed_lines("\n")
+
     def _log_output(self, out, report_progress):
         self.log_file.write(out)
-        self.log_file.flush()
+        if self._captured is not None:
+            self._captured.append(out)
 
         if self.verbose:
-            sys.stdout.write(out)
-            sys.stdout.flush()
+            if self.prefix:
+                self._write_prefixed_lines(out)
+            else:
+                sys.stdout.write(out)
+                sys.stdout.flush()
+
+        show_progress = report_progress and not self.verbose and not self.prefix
+        if not show_progress and not self.status:
             return
 
-        if not report_progress:
+        now = time.time()
+        if now - self._last_progress < PROGRESS_INTERVAL:
             return
+        for line in reversed(out.rsplit("\n", PROGRESS_LINES)):
+            progress = parse_progress(line.rsplit("\r", 1)[-1])
+            if progress is not None:
+                self._last_progress = now
+                if self.status:
+                    self.status.set_progress(progress)
+                if show_progress:
+                    sys.stdout.write("\r%s - %d%%" % (self._log_msg, progress * 100))
+                    sys.stdout.flush()
+                return
 
-        percent = extract_progress(out)
-        if percent is not None:
-            sys.stdout.write("\r" + self._log_msg + " - " + percent)
+    def _write_prefixed_lines(self, out):
+        """
+        Write complete lines of out to stdout, prefixed with self.prefix. The
+        last line is kept until it is complete.
+        """
+        lines = (self._partial_line + out).split("\n")
+        self._partial_line = lines.pop()
+        if not lines:
+            return
+        txt = "".join("%s| %s\n" % (self.prefix, x) for x in lines)
+        with flog.output():
+            sys.stdout.write(txt)
             sys.stdout.flush()
@@ -0,0 +1,264 @@
+import heapq
+import logging
+import threading
+import Queue
+
+from batchbuilderror import BatchBuildError
+
+
+def parse_depends_on(value):
+    """
+    Returns the list of module names from a depends-on value, which can either
+    be a list or a space-separated string
+    """
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        return value.split()
+    return list(value)
+
+
+def complete_estimates(names, known):
+    """
+    Returns a dict of name => estimated build duration for all names, from a
+    dict of known durations. Modules without a known duration are estimated to
+    take the mean of the known durations.
+    """
+    if known:
+        default = sum(known.values()) / float(len(known))
+    else:
+        default = 0
+    return dict((x, known.get(x, default)) for x in names)
+
+
+def pick_ready(ready, priorities, order):
+    """
+    Returns the module to start among the ready ones: the one with the highest
+    priority, or the first one in order if priorities are equal
+    """
+    return max(ready, key=lambda x: (priorities.get(x, 0), -order.index(x)))
+
+
+def plan_schedule(graph, jobs, estimates):
+    """
+    Simulates the build of graph with up to `jobs` modules built at the same
+    time. Returns a list of (start time, name) and the estimated total time.
+    """
+    priorities = graph.priorities(estimates)
+    waiting = dict((x, len(graph.deps[x])) for x in graph.names)
+    ready = [x for x in graph.names if waiting[x] == 0]
+    running = []
+    now = 0
+    plan = []
+    while ready or running:
+        while ready and len(running) < jobs:
+            name = pick_ready(ready, priorities, graph.names)
+            ready.remove(name)
+            plan.append((now, name))
+            heapq.heappush(running, (now + estimates.get(name, 0), name))
+        now, name = heapq.heappop(running)
+        for dependent in graph.dependents[name]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+    return plan, now
+
+
+class ModuleGraph(object):
+    """
+    Dependency graph of a list of module configs.
+
+    A module depends on the modules listed in its `depends-on` option. Modules
+    without `depends-on` depend on the module preceding them in the list.
+    Dependencies on modules which are not part of the list are ignored: they
+    are considered already built. They are still listed in `upstream`.
+
+    If upstream is set, it is a dict of name => names of the modules it depends
+    on, used instead of the `depends-on` options.
+    """
+    def __init__(self, module_configs, upstream=None):
+        self.configs = module_configs
+        self.names = [x.flat_get("name") for x in module_configs]
+        self.config_for_name = dict(zip(self.names, module_configs))
+        self.deps = {}
+        self.upstream = {}
+        self.dependents = dict((x, []) for x in self.names)
+
+        previous = None
+        for name, config in zip(self.names, module_configs):
+            if upstream is not None:
+                depends_on = upstream[name]
+            else:
+                depends_on = parse_depends_on(config.flat_get("depends-on"))
+            if depends_on is None:
+                depends_on = [previous] if previous else []
+            deps = [x for x in depends_on if x in self.config_for_name]
+            self.upstream[name] = depends_on
+            self.deps[name] = deps
+            for dep in deps:
+                self.dependents[dep].append(name)
+            previous = name
+
+        self.order = self._sort()
+
+    def subgraph(self, names):
+        """
+        Returns the graph of the modules of names, keeping their dependencies.
+        Modules which depended on the module preceding them in the list still
+        do, even if it is not part of names.
+        """
+        names = set(names)
+        configs = [self.config_for_name[x] for x in self.names if x in names]
+        return ModuleGraph(configs, dict((x, self.upstream[x]) for x in names))
+
+    def downstream(self, name):
+        """
+        Returns the set of modules which depend, directly or not, on name
+        """
+        result = set()
+        todo = list(self.dependents[name])
+        while todo:
+            dependent = todo.pop()
+            if dependent in result:
+                continue
+            result.add(dependent)
+            todo.extend(self.dependents[dependent])
+        return result
+
+    def priorities(self, estimates):
+        """
+        Returns a dict of name => estimated duration of the longest chain of
+        modules starting with this module. Starting modules with the highest
+        priority first shortens the total build time.
+        """
+        priorities = {}
+        for name in reversed(self.order):
+            chains = [priorities[x] for x in self.dependents[name]]
+            priorities[name] = estimates.get(name, 0) + max(chains or [0])
+        return priorities
+
+    def critical_path(self, durations):
+        """
+        Returns a tuple (duration, names) for the chain of dependent modules
+        which takes the longest to build, durations being a dict of
+        name => build duration
+        """
+        best = {}
+        for name in self.order:
+            chains = [best[x] for x in self.deps[name]]
+            duration, names = max(chains) if chains else (0, [])
+            best[name] = (duration + durations.get(name, 0), names + [name])
+        if not best:
+            return 0, []
+        return max(best.values())
+
+    def _sort(self):
+        """
+        Returns module names sorted so that modules come after their
+        dependencies
+        """
+        order = []
+        remaining = dict((x, len(self.deps[x])) for x in self.names)
+        todo = [x for x in self.names if remaining[x] == 0]
+        while todo:
+            name = todo.pop(0)
+            order.append(name)
+            del remaining[name]
+            for dependent in self.dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    todo.append(dependent)
+        if remaining:
+            raise BatchBuildError("Dependency cycle between modules: %s"
+                                  % ", ".join(sorted(remaining)))
+        return order
+
+
+class Scheduler(object):
+    """
+    Runs build_fn(config) for all modules of graph, using up to `jobs` worker
+    threads. A module is started once all its dependencies have been built.
+
+    build_fn must return True on success. If fatal is True, the dependents of a
+    failed module are cancelled, other modules keep building.
+
+    estimates is a dict of name => estimated build duration. It is used to
+    start the modules on the longest chains first. Without estimates, modules
+    are started in list order.
+    """
+    def __init__(self, graph, jobs, build_fn, fatal, estimates=None):
+        self.graph = graph
+        self.jobs = jobs
+        self.build_fn = build_fn
+        self.fatal = fatal
+        self.priorities = graph.priorities(estimates or {})
+
+    def run(self):
+        """
+        Build all modules, returns the list of cancelled module names
+        """
+        graph = self.graph
+        waiting = dict((x, len(graph.deps[x])) for x in graph.names)
+        ready = [x for x in graph.names if waiting[x] == 0]
+        for name in ready:
+            del waiting[name]
+        cancelled = []
+        job_queue = Queue.Queue()
+        done_queue = Queue.Queue()
+
+        workers = []
+        for idx in range(min(self.jobs, len(graph.names))):
+            worker = threading.Thread(target=self._work, args=(job_queue, done_queue))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        running = 0
+        while ready or running:
+            while ready and running < len(workers):
+                name = pick_ready(ready, self.priorities, graph.names)
+                ready.remove(name)
+                job_queue.put(name)
+                running += 1
+
+            name, ok = self._wait(done_queue)
+            running -= 1
+            if not ok and self.fatal:
+                for dependent in graph.downstream(name):
+                    if dependent in waiting:
+                        del waiting[dependent]
+                        cancelled.append(dependent)
+                continue
+            for dependent in graph.dependents[name]:
+                if dependent not in waiting:
+                    continue
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    del waiting[dependent]
+                    ready.append(dependent)
+
+        for worker in workers:
+            job_queue.put(None)
+        for worker in workers:
+            worker.join()
+        return [x for x in graph.names if x in cancelled]
+
+    def _wait(self, done_queue):
+        # Use a timeout so that KeyboardInterrupt is not blocked
+        while True:
+            try:
+                return done_queue.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def _work(self, job_queue, done_queue):
+        while True:
+            name = job_queue.get()
+            if name is None:
+                return
+            try:
+                ok = self.build_fn(self.graph.config_for_name[name])
+            except Exception:
+                logging.exception("Unexpected error while building %s", name)
+                ok = False
+            done_queue.put((name, ok))
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+
+
+STATE_FILE_NAME = "bb-state.json"
+
+
+def hash_config(config):
+    """
+    Returns a hash of the effective values of a CascadedConfig
+    """
+    dump = json.dumps(config.flatten(), sort_keys=True)
+    return hashlib.sha1(dump).hexdigest()
+
+
+def fingerprint_state(state):
+    """
+    Returns a hash of a module state
+    """
+    dump = json.dumps(state, sort_keys=True)
+    return hashlib.sha1(dump).hexdigest()
+
+
+class StateStore(object):
+    """
+    Keeps track of the state of each module when it was last successfully
+    built, in a json file stored in the build base dir of the devo.
+
+    A module state is a dict made of:
+    - revision: the VCS revision of the module source
+    - config: the hash of the module config
+    - upstream: a dict of upstream module name => upstream fingerprint
+
+    The fingerprint of a module is a hash of its state, so a module state
+    changes whenever the state of one of its upstream modules changes.
+    """
+    def __init__(self, build_base_dir):
+        self.file_name = os.path.join(build_base_dir, STATE_FILE_NAME)
+        self._lock = threading.Lock()
+        self._states = {}
+        if os.path.exists(self.file_name):
+            try:
+                with open(self.file_name) as fp:
+                    self._states = json.load(fp)
+            except ValueError:
+                # Corrupted file, everything will be rebuilt
+                pass
+
+    def create_state(self, module, upstream_names):
+        """
+        Returns the current state of module
+        """
+        return self.create_state_for_revision(module.revision(), module.config, upstream_names)
+
+    def create_state_for_revision(self, revision, config, upstream_names):
+        """
+        Returns the state of a module whose source is at revision, for modules
+        whose source is not available locally
+        """
+        upstream = dict((x, self.fingerprint(x)) for x in upstream_names)
+        return {
+            "revision": revision,
+            "config": hash_config(config),
+            "upstream": upstream,
+        }
+
+    def is_up_to_date(self, name, state):
+        """
+        Returns True if state matches the state of the last successful build
+        of module name
+        """
+        if state["revision"] is None:
+            return False
+        with self._lock:
+            stored = self._states.get(name)
+        if stored is None:
+            return False
+        return stored["state"] == state
+
+    def fingerprint(self, name):
+        with self._lock:
+            stored = self._states.get(name)
+        if stored is None:
+            return None
+        return stored["fingerprint"]
+
+    def set_built(self, name, state):
+        """
+        Record that module name has been successfully built in state
+        """
+        fingerprint = fingerprint_state(state)
+        with self._lock:
+            self._states[name] = {"state": state, "fingerprint": fingerprint}
+            self._save()
+
+    def forget(self, name):
+        """
+        Forget the last build of module name, so that it is built again
+        """
+        with self._lock:
+            if self._states.pop(name, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, "w") as fp:
+            json.dump(self._states, fp, indent=2, sort_keys=True)
+        os.rename(tmp_name, self.file_name)
@@ -0,0 +1,120 @@
+import os
+
+from timingdb import TimingDb
+
+TARGET_DB_NAME = "targets.jsonl"
+
+NINJA_LOG_NAME = ".ninja_log"
+
+COMPILE_SUFFIXES = (".o", ".obj")
+LINK_SUFFIXES = (".a", ".so", ".dylib", ".dll", ".exe")
+
+# Target kinds
+COMPILE = "compile"
+LINK = "link"
+OTHER = "other"
+
+
+def classify_target(target):
+    name = os.path.basename(target)
+    if name.endswith(COMPILE_SUFFIXES):
+        return COMPILE
+    if name.endswith(LINK_SUFFIXES) or ".so." in name or "." not in name:
+        # Executables usually have no extension
+        return LINK
+    return OTHER
+
+
+def get_time_trace_name(build_dir, target):
+    """
+    Returns the name of the trace written by clang -ftime-trace for target, or
+    None if there is none
+    """
+    name = os.path.join(build_dir, os.path.splitext(target)[0] + ".json")
+    return name if os.path.exists(name) else None
+
+
+def has_ninja_log(build_dir):
+    return os.path.exists(os.path.join(build_dir, NINJA_LOG_NAME))
+
+
+def get_ninja_log_size(build_dir):
+    try:
+        return os.path.getsize(os.path.join(build_dir, NINJA_LOG_NAME))
+    except OSError:
+        return 0
+
+
+def read_ninja_log(build_dir, offset):
+    """
+    Returns a list of (target, duration) for the edges ninja ran since its log
+    had offset bytes. Edges with several outputs are returned once, under their
+    first output.
+    """
+    name = os.path.join(build_dir, NINJA_LOG_NAME)
+    if not os.path.exists(name):
+        return []
+    if os.path.getsize(name) < offset:
+        # ninja rewrote its log to drop old entries, we cannot tell which
+        # ones are new
+        offset = 0
+    seen = set()
+    result = []
+    with open(name) as fp:
+        fp.seek(offset)
+        for line in fp:
+            if line.startswith("#"):
+                continue
+            # start, end, mtime, output, command hash
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            try:
+                start, end = int(fields[0]), int(fields[1])
+            except ValueError:
+                continue
+            key = (start, end, fields[4])
+            if key in seen:
+                continue
+            seen.add(key)
+            result.append((fields[3], (end - start) / 1000.))
+    return result
+
+
+class TargetDb(TimingDb):
+    """
+    Record of the time spent on each target of the modules built with
+    --profile, stored like TimingDb entries.
+
+    Each entry contains:
+    - run: id of the devo-batchbuild run
+    - project: name of the project file
+    - module: name of the module
+    - target: path of the target, relative to the module build dir
+    - kind: compile, link or other
+    - duration: in seconds
+    - trace: path of the -ftime-trace output for the target, if any
+    """
+    def __init__(self, log_dir):
+        TimingDb.__init__(self, log_dir)
+        self.file_name = os.path.join(log_dir, TARGET_DB_NAME)
+
+    def add_ninja_targets(self, run_id, project, module, offset):
+        """
+        Record the targets ninja built for module since its log had offset
+        bytes. Returns the number of recorded targets, or None if the module
+        is not built with ninja.
+        """
+        if not has_ninja_log(module.build_dir):
+            return None
+        targets = read_ninja_log(module.build_dir, offset)
+        self.add_all([{
+            "run": run_id,
+            "project": project,
+            "module": module.name,
+            "target": target,
+            "kind": classify_target(target),
+            "duration": duration,
+            "trace": get_time_trace_name(module.build_dir, target),
+        } for target, duration in targets])
+        return len(targets)
@@ -0,0 +1,158 @@
+import json
+import os
+import re
+import threading
+import time
+
+from batchbuilderror import BatchBuildError
+
+
+TIMING_DB_NAME = "timings.jsonl"
+
+# Steps of a module, in the order they run
+STEPS = ("switch-branch", "checkout", "update", "configure", "build", "install")
+
+# Matches durations like "90", "30s", "10m" or "1h30m"
+DURATION_RX = re.compile(r"^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?$")
+
+
+def format_duration(duration):
+    hours, rest = divmod(duration, 3600)
+    minutes, seconds = divmod(rest, 60)
+    lst = []
+    if hours > 0:
+        lst.append("%dh" % hours)
+    if minutes > 0 or hours > 0:
+        lst.append("%dm" % minutes)
+    lst.append("%ds" % seconds)
+    return " ".join(lst)
+
+
+def parse_duration(text):
+    """
+    Converts a duration like "90", "30s", "10m" or "1h30m" to a number of
+    seconds
+    """
+    text = str(text).replace(" ", "")
+    match = DURATION_RX.match(text)
+    if not text or not match:
+        raise BatchBuildError("Invalid duration: %s" % text)
+    hours, minutes, seconds = [int(x or 0) for x in match.groups()]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class TimingDb(object):
+    """
+    Append-only record of the steps run for each module, stored as one json
+    object per line in the log dir.
+
+    Each entry contains:
+    - run: id of the devo-batchbuild run
+    - project: name of the project file
+    - module: name of the module
+    - step: checkout, update, switch-branch, configure, build or install
+    - start: start time, in seconds since the epoch
+    - duration: in seconds
+    - exit_code: exit code of the command
+    - max_rss_kb: peak resident memory of the command and its children
+    - cpu_time: user + system CPU time of the command and its children
+    """
+    def __init__(self, log_dir):
+        self.file_name = os.path.join(log_dir, TIMING_DB_NAME)
+        self._lock = threading.Lock()
+
+    def create_recorder(self, run_id, project, module_name):
+        """
+        Returns a function to pass as Runner record_step argument
+        """
+        def record_step(step, start_time, duration, exit_code, rusage):
+            self.add({
+                "run": run_id,
+                "project": project,
+                "module": module_name,
+                "step": step,
+                "start": start_time,
+                "duration": duration,
+                "exit_code": exit_code,
+                "max_rss_kb": rusage.ru_maxrss if rusage else None,
+                "cpu_time": rusage.ru_utime + rusage.ru_stime if rusage else None,
+            })
+        return record_step
+
+    def add(self, entry):
+        self.add_all([entry])
+
+    def add_all(self, entries):
+        data = "".join(json.dumps(x, sort_keys=True) + "\n" for x in entries)
+        with self._lock:
+            with open(self.file_name, "a") as fp:
+                fp.write(data)
+
+    def read(self, project=None):
+        """
+        Yields all entries, optionally only those of project
+        """
+        if not os.path.exists(self.file_name):
+            return
+        with open(self.file_name) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Truncated line, for example if we got killed
+                    continue
+                if project is None or entry["project"] == project:
+                    yield entry
+
+
+def create_run_id():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_durations_by_run(entries):
+    """
+    Returns a list of (run_id, durations), in chronological order. durations is
+    a dict of module name => dict of step => duration
+    """
+    runs = []
+    durations_for_run = {}
+    for entry in entries:
+        run_id = entry["run"]
+        if run_id not in durations_for_run:
+            runs.append(run_id)
+            durations_for_run[run_id] = {}
+        steps = durations_for_run[run_id].setdefault(entry["module"], {})
+        steps[entry["step"]] = steps.get(entry["step"], 0) + entry["duration"]
+    return [(x, durations_for_run[x]) for x in runs]
+
+
+def estimate_step_durations(entries, run_count=3):
+    """
+    Returns a dict of module name => dict of step => mean duration of the step
+    over the last run_count builds of the module. Runs where the module was
+    not built, or where one of its steps failed or timed out, are ignored.
+    entries should only contain the entries of one project.
+    """
+    entries = list(entries)
+    failed = set((x["run"], x["module"]) for x in entries if x.get("exit_code") != 0)
+    history = {}
+    for run_id, durations in get_durations_by_run(entries):
+        for name, steps in durations.items():
+            if "build" in steps and (run_id, name) not in failed:
+                history.setdefault(name, []).append(steps)
+    result = {}
+    for name, lst in history.items():
+        lst = lst[-run_count:]
+        step_names = set(x for steps in lst for x in steps)
+        result[name] = dict((x, sum(steps.get(x, 0) for steps in lst) / len(lst))
+                            for x in step_names)
+    return result
+
+
+def estimate_durations(entries, run_count=3):
+    """
+    Returns a dict of module name => mean duration of the module over its last
+    run_count builds, see estimate_step_durations()
+    """
+    return dict((name, sum(steps.values()))
+                for name, steps in estimate_step_durations(entries, run_count).items())
@@ -1,6 +1,12 @@
+import hashlib
 import os
+import pipes
+import re
 import subprocess
 
+from batchbuilderror import BatchBuildError
+from mirrors import get_mirror_set
+
 
 class BaseVcs(object):
     def __init__(self, module):
@@ -15,6 +21,67 @@ class BaseVcs(object):
     def update(self, runner):
         raise NotImplementedError
 
+    def revision(self):
+        """
+        Returns a string identifying the revision of the checkout, or None if
+        it cannot be determined or if the checkout contains local changes
+        """
+        return None
+
+    def has_upstream_changes(self):
+        """
+        Returns False if the remote repository has nothing the checkout does
+        not already have, True if it has or if it cannot be determined
+        """
+        return True
+
+    def _get_output(self, args):
+        """
+        Runs args in the source dir, returns its stripped output or None if it
+        failed
+        """
+        try:
+            with open(os.devnull, "w") as null:
+                output = subprocess.check_output(args, cwd=self.module.src_dir, stderr=null)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return output.strip()
+
+    def _get_exit_code(self, args):
+        """
+        Runs args in the source dir, returns its exit code or None if it could
+        not be started
+        """
+        try:
+            with open(os.devnull, "w") as null:
+                return subprocess.call(args, cwd=self.module.src_dir, stdout=null, stderr=null)
+        except OSError:
+            return None
+
+
+def has_svn_upstream_changes(vcs):
+    # Directories last-changed-revision is bumped when anything below them
+    # changes
+    args = ["svn", "info", "--non-interactive", "--show-item", "last-changed-revision"]
+    local = vcs._get_output(args)
+    remote = vcs._get_output(args + [vcs.module.url])
+    if not local or not remote:
+        return True
+    return local != remote
+
+
+def get_first_words(output):
+    return [x.split()[0] for x in output.splitlines() if x.strip()]
+
+
+def get_svn_revision(vcs):
+    output = vcs._get_output(["svnversion"])
+    # Local modifications are flagged with "M", unversioned dirs are not
+    # reported with a number
+    if not output or not output[0].isdigit() or "M" in output:
+        return None
+    return output
+
 
 class Svn(BaseVcs):
     def checkout(self, runner):
@@ -24,6 +91,12 @@ class Svn(BaseVcs):
     def update(self, runner):
         runner.run(self.module.src_dir, "svn up --non-interactive")
 
+    def revision(self):
+        return get_svn_revision(self)
+
+    def has_upstream_changes(self):
+        return has_svn_upstream_changes(self)
+
 
 class Git(BaseVcs):
     def __init__(self, module):
@@ -32,16 +105,62 @@ class Git(BaseVcs):
         self.branch = module.branch
         if self.branch == "":
             self.branch = "master"
+        self.depth = module.config.get("clone-depth")
+        self.filter = module.config.get("clone-filter")
+        self.reference_dir = module.config.get("clone-reference-dir")
+        # Expanding vars is useful for tests
+        mirror_dir = os.path.expandvars(module.config.get("mirror-dir", ""))
+        self.mirrors = get_mirror_set(mirror_dir) if mirror_dir else None
+
+    def _git(self):
+        """
+        Returns the git command to use for commands which access the remote
+        repository: they go through the mirrors, if any
+        """
+        if self.mirrors:
+            return "git" + self.mirrors.get_git_options(self.url)
+        return "git"
+
+    def _git_args(self):
+        """
+        Same as _git(), but returns a list of arguments
+        """
+        if self.mirrors:
+            return ["git"] + self.mirrors.get_git_args(self.url)
+        return ["git"]
 
     def checkout(self, runner):
-        cmd = "git clone --recursive"
+        cmd = self._git() + " clone --recursive"
         if self.branch != "master":
             cmd += " --branch " + self.branch
+        cmd += self._get_clone_options()
         cmd += " %s %s" % (self.url, self.module.name)
         runner.run(self.module.base_dir, cmd)
 
+    def _get_clone_options(self):
+        opts = ""
+        if self.depth:
+            # Keep all branches so that switch_branch() still works
+            opts += " --depth %d --no-single-branch --shallow-submodules" % int(self.depth)
+        if self.filter:
+            opts += " --filter=" + self.filter
+        if self.reference_dir:
+            reference = os.path.join(os.path.expanduser(os.path.expandvars(self.reference_dir)),
+                                     self.module.name + ".git")
+            opts += " --reference-if-able " + reference
+        return opts
+
+    def _get_submodule_update_options(self):
+        opts = ""
+        if self.depth:
+            opts += " --depth %d" % int(self.depth)
+        if self.filter:
+            # git only accepts --filter when initializing submodules
+            opts += " --init --filter=" + self.filter
+        return opts
+
     def switch_branch(self, runner):
-        runner.run(self.module.src_dir, "git fetch")
+        runner.run(self.module.src_dir, self._git() + " fetch")
         if self.branch in self._list_local_branches():
             cmd = "git checkout "  + self.branch
         else:
@@ -49,8 +168,32 @@ class Git(BaseVcs):
         runner.run(self.module.src_dir, cmd)
 
     def update(self, runner):
-        runner.run(self.module.src_dir, "git pull --rebase")
-        runner.run(self.module.src_dir, "git submodule update")
+        runner.run(self.module.src_dir, self._git() + " pull --rebase")
+        runner.run(self.module.src_dir, self._git() + " submodule update" + self._get_submodule_update_options())
+
+    def revision(self):
+        if self._get_output(["git", "status", "--porcelain", "--untracked-files=no"]) != "":
+            return None
+        head = self._get_output(["git", "rev-parse", "HEAD"])
+        submodules = self._get_output(["git", "submodule", "status", "--recursive"])
+        if not head or submodules is None:
+            return None
+        if submodules:
+            head += "+" + hashlib.sha1(submodules).hexdigest()
+        return head
+
+    def has_upstream_changes(self):
+        if self._get_output(["git", "symbolic-ref", "--short", "HEAD"]) != self.branch:
+            return True
+        output = self._get_output(self._git_args() + ["ls-remote", self.url, "refs/heads/" + self.branch])
+        if not output:
+            return True
+        remote = output.split()[0]
+        local = self._get_output(["git", "rev-parse", "refs/remotes/origin/" + self.branch])
+        if remote != local:
+            return True
+        # Make sure the last pull has been applied
+        return self._get_exit_code(["git", "merge-base", "--is-ancestor", local, "HEAD"]) != 0
 
     def _list_local_branches(self):
         output = subprocess.check_output(["git", "branch"], cwd=self.module.src_dir)
@@ -72,6 +215,15 @@ class Bzr(BaseVcs):
     def update(self, runner):
         runner.run(self.module.src_dir, "bzr pull")
 
+    def revision(self):
+        if self._get_output(["bzr", "status", "--short"]) != "":
+            return None
+        return self._get_output(["bzr", "revision-info"]) or None
+
+    def has_upstream_changes(self):
+        # Exits with 1 if there are missing revisions
+        return self._get_exit_code(["bzr", "missing", "--theirs-only", "-q"]) != 0
+
 
 class Hg(BaseVcs):
     def checkout(self, runner):
@@ -81,6 +233,38 @@ class Hg(BaseVcs):
     def update(self, runner):
         runner.run(self.module.src_dir, "hg pull")
 
+    def revision(self):
+        output = self._get_output(["hg", "id", "--id", "--debug"])
+        # Local modifications are flagged with "+"
+        if not output or output.endswith("+"):
+            return None
+        return output
+
+    def has_upstream_changes(self):
+        # Exits with 1 if there are no incoming changes
+        return self._get_exit_code(["hg", "incoming", "-q"]) != 1
+
+
+SVN_UPDATING_RX = re.compile(r"^Updating '(.*)':$")
+SVN_UPDATED_RX = re.compile(r"^(?:At|Updated to) revision \d+\.$")
+
+
+def get_updated_svn_dirs(output):
+    """
+    Returns the dirs an "svn up" of several dirs finished updating, according
+    to its output
+    """
+    updated = set()
+    current = None
+    for line in output.splitlines():
+        match = SVN_UPDATING_RX.match(line)
+        if match:
+            current = os.path.normpath(match.group(1))
+        elif current and SVN_UPDATED_RX.match(line):
+            updated.add(current)
+            current = None
+    return updated
+
 
 class PartialSvn(BaseVcs):
     def __init__(self, module, repo_dirs):
@@ -90,8 +274,46 @@ class PartialSvn(BaseVcs):
     def checkout(self, runner):
         cmd = "svn checkout --depth files %s %s" % (self.module.url, self.module.name)
         runner.run(self.module.base_dir, cmd)
-        self.update(runner)
+        # Only fetch the wanted dirs, instead of fetching everything and
+        # trimming afterwards
+        self._update_dirs(runner, "svn up --non-interactive --parents --set-depth infinity")
 
     def update(self, runner):
-        for repo_dir in self.repo_dirs:
-            runner.run(self.module.src_dir, "svn up --non-interactive " + repo_dir)
+        self._update_dirs(runner, "svn up --non-interactive")
+
+    def _update_dirs(self, runner, cmd):
+        """
+        Run cmd on all repo dirs at once. svn logs an "Updating '<dir>'" line
+        before the output of each dir. If it fails, run it again dir by dir on
+        the dirs it did not update, so that the error points to the failing
+        dir.
+        """
+        dirs = " ".join(pipes.quote(x) for x in self.repo_dirs)
+        output = []
+        try:
+            with runner.capture_output(output):
+                runner.run(self.module.src_dir, cmd + " " + dirs)
+            return
+        except BatchBuildError, exc:
+            reason = str(exc)
+        updated = get_updated_svn_dirs("".join(output))
+        remaining = [x for x in self.repo_dirs if os.path.normpath(x) not in updated]
+        runner.report(runner.step, "%s, updating the remaining dirs one by one: %s"
+                      % (reason, " ".join(remaining)))
+        for repo_dir in remaining:
+            runner.run(self.module.src_dir, cmd + " " + pipes.quote(repo_dir))
+
+    def revision(self):
+        return get_svn_revision(self)
+
+    def has_upstream_changes(self):
+        # Only the repo dirs are updated, the root of the checkout stays at the
+        # revision it was checked out at: compare the repo dirs revisions
+        args = ["svn", "info", "--non-interactive", "--show-item", "last-changed-revision"]
+        local = self._get_output(args + list(self.repo_dirs))
+        url = self.module.url.rstrip("/")
+        remote = self._get_output(args + [url + "/" + x for x in self.repo_dirs])
+        if not local or not remote:
+            return True
+        # With several targets, each line is "<revision> <target>"
+        return get_first_words(local) != get_first_words(remote)
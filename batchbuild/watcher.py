@@ -0,0 +1,171 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+from batchbuilderror import BatchBuildError
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 00004000
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Once a change has been seen, wait until there has been no change for this
+# long, in seconds, so that saving several files or a "git checkout" trigger
+# only one build
+DEBOUNCE_DELAY = 0.3
+
+# Dirs which are never watched
+IGNORED_DIRS = set([".git", ".svn", ".hg", ".bzr", "CVS"])
+
+# Editor temporary files, whose changes are ignored
+IGNORED_PREFIXES = (".#",)
+IGNORED_SUFFIXES = ("~", ".swp", ".swx", ".tmp")
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise BatchBuildError("Watching sources requires inotify")
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def is_ignored_file(name):
+    return name.startswith(IGNORED_PREFIXES) or name.endswith(IGNORED_SUFFIXES)
+
+
+class SourceWatcher(object):
+    """
+    Watches the source dirs of modules with inotify, and tells which modules
+    changed. Each dir of a source tree needs its own watch, dirs created later
+    are watched as they appear.
+    """
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise_errno("Could not initialize inotify")
+        # name => excluded dirs of the watched modules
+        self._modules = {}
+        # watch descriptor => (path, set of module names)
+        self._watches = {}
+
+    def close(self):
+        os.close(self._fd)
+
+    def is_watched(self, name):
+        return name in self._modules
+
+    def add(self, name, src_dir, excluded_dirs=()):
+        """
+        Watch src_dir for changes to module name, except in excluded_dirs
+        """
+        self._modules[name] = [os.path.join(x, "") for x in excluded_dirs]
+        self._add_tree(src_dir, name)
+
+    def wait(self):
+        """
+        Blocks until something changes, then returns the names of the modules
+        which changed
+        """
+        names = set()
+        timeout = None
+        while True:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                if names:
+                    return names
+                continue
+            names.update(self._read_events())
+            if names:
+                timeout = DEBOUNCE_DELAY
+
+    def _is_excluded(self, name, path):
+        path = os.path.join(path, "")
+        return any(path.startswith(x) for x in self._modules[name])
+
+    def _add_tree(self, root, name):
+        for dir_name, dir_names, _ in os.walk(root):
+            dir_names[:] = [x for x in dir_names if x not in IGNORED_DIRS]
+            if self._is_excluded(name, dir_name):
+                dir_names[:] = []
+                continue
+            self._add_watch(dir_name, name)
+
+    def _add_watch(self, path, name):
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Removed since it was listed
+                return
+            if err == errno.ENOSPC:
+                raise BatchBuildError("Too many dirs to watch, increase"
+                                      " /proc/sys/fs/inotify/max_user_watches")
+            self._raise_errno("Could not watch %s" % path)
+        # The same dir can be watched for several modules, inotify then
+        # returns the same watch descriptor
+        self._watches.setdefault(wd, (path, set()))[1].add(name)
+
+    def _read_events(self):
+        """
+        Returns the names of the modules with changes in the pending events
+        """
+        names = set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError, exc:
+            if exc.errno == errno.EAGAIN:
+                return names
+            raise
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            file_name = data[pos:pos + length].rstrip("\0")
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, assume everything changed
+                names.update(self._modules)
+                continue
+            if wd not in self._watches:
+                continue
+            path, wd_names = self._watches[wd]
+            if mask & IN_IGNORED:
+                # Dir removed, its watch is gone
+                del self._watches[wd]
+                continue
+            if mask & IN_ISDIR:
+                if file_name in IGNORED_DIRS:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    for name in wd_names:
+                        self._add_tree(os.path.join(path, file_name), name)
+            elif is_ignored_file(file_name):
+                continue
+            full_path = os.path.join(path, file_name)
+            names.update(x for x in wd_names if not self._is_excluded(x, full_path))
+        return names
+
+    def _raise_errno(self, message):
+        raise BatchBuildError("%s: %s" % (message, os.strerror(ctypes.get_errno())))
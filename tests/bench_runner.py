@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compare the time taken by Runner to process a large build log with the time
+taken by the previous, line-based, implementation.
+
+Usage: bench_runner.py [captured-build-log]
+
+If no log is given, a make-like log of 200000 lines is generated.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "batchbuild"))
+
+from batchbuilderror import BatchBuildError
+from runner import Runner, extract_progress
+
+GENERATED_LINE_COUNT = 200000
+
+
+class LegacyRunner(Runner):
+    """
+    The Runner implementation which used to read, flush and look for progress
+    on every line
+    """
+    def run(self, cwd, command, env=None, report_progress=False):
+        self._log_msg = command
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
+        while True:
+            out = process.stdout.readline()
+            self._log_output(out, report_progress)
+            process.poll()
+            ret = process.returncode
+            if ret is not None:
+                if ret != 0:
+                    raise BatchBuildError("Command '%s' failed with exit code %d" % (command, ret))
+                else:
+                    return
+
+    def _log_output(self, out, report_progress):
+        self.log_file.write(out)
+        self.log_file.flush()
+        if not report_progress:
+            return
+        percent = extract_progress(out)
+        if percent is not None:
+            sys.stdout.write("\r" + self._log_msg + " - " + percent)
+            sys.stdout.flush()
+
+
+def generate_log(fp):
+    for idx in range(GENERATED_LINE_COUNT):
+        percent = idx * 100 / GENERATED_LINE_COUNT
+        fp.write("[%3d%%] Building CXX object src/CMakeFiles/foo.dir/file%d.cpp.o\n" % (percent, idx))
+
+
+def bench(runner_class, log_name):
+    out_fd, out_name = tempfile.mkstemp(prefix="bench-runner-")
+    os.close(out_fd)
+    old_stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        with open(out_name, "w") as log_file:
+            runner = runner_class(log_file, verbose=False)
+            start = time.time()
+            runner.run(os.getcwd(), "cat " + log_name, report_progress=True)
+            duration = time.time() - start
+        size = os.path.getsize(out_name)
+    finally:
+        sys.stdout = old_stdout
+        os.unlink(out_name)
+    return duration, size
+
+
+def main():
+    if len(sys.argv) > 1:
+        log_name = sys.argv[1]
+        tmp_name = None
+    else:
+        fd, tmp_name = tempfile.mkstemp(prefix="bench-runner-log-")
+        with os.fdopen(fd, "w") as fp:
+            generate_log(fp)
+        log_name = tmp_name
+
+    try:
+        expected_size = os.path.getsize(log_name)
+        for runner_class in LegacyRunner, Runner:
+            duration, size = bench(runner_class, log_name)
+            status = "ok" if size >= expected_size else "LOST OUTPUT"
+            print "%-12s %6.2fs %s" % (runner_class.__name__, duration, status)
+    finally:
+        if tmp_name:
+            os.unlink(tmp_name)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+# vi: ts=4 sw=4 et
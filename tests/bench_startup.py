@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Measure the startup time of devo-batchbuild, and the time spent importing
+each module, in the spirit of `python -X importtime` (which Python 2 lacks).
+
+Usage: bench_startup.py [devo-batchbuild arguments]
+
+Arguments default to "-l". Set DEVO_OVERLAY_DIR to pick the yaml files to
+use, and the devo environment variables for arguments like --dry-run.
+
+Exits with 1 if "-l" or "--dry-run" loaded one of the modules only needed to
+build.
+"""
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "batchbuild", "devo-batchbuild.py")
+
+RUN_COUNT = 10
+
+# Modules which are not needed to list projects or print a dry-run schedule
+HEAVY_MODULES = ("yaml", "dbus", "module", "runner", "vcs", "nanotify", "tarfile",
+                 "multiprocessing", "subprocess")
+
+# Modules which must not be loaded to list projects or print a dry-run
+# schedule
+BUILD_MODULES = ("builder", "nanotify")
+
+LIGHT_ARGS = ("-l", "--list", "--dry-run")
+
+# Executed in a child interpreter: wraps __import__ to log the cumulative time
+# of the first import of each module to stderr, then runs the script
+BOOTSTRAP = r"""
+import __builtin__, sys, time
+_import = __builtin__.__import__
+_depth = [0]
+def _timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return _import(name, *args, **kwargs)
+    _depth[0] += 1
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        _depth[0] -= 1
+        if name in sys.modules:
+            sys.stderr.write("import time: %d|%d|%s\n" % ((time.time() - start) * 1e6, _depth[0], name))
+__builtin__.__import__ = _timed_import
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path.insert(0, __import__("os").path.dirname(script))
+__name__ = "__main__"
+execfile(script)
+"""
+
+
+def measure_wall_time(args):
+    """
+    Returns the median wall time of RUN_COUNT runs of the script
+    """
+    durations = []
+    with open(os.devnull, "w") as null:
+        for _ in range(RUN_COUNT):
+            start = time.time()
+            subprocess.call([sys.executable, SCRIPT] + args, stdout=null, stderr=null)
+            durations.append(time.time() - start)
+    return sorted(durations)[RUN_COUNT / 2]
+
+
+def measure_imports(args):
+    """
+    Returns a list of (cumulative time in us, depth, module name), in the
+    order the imports finished
+    """
+    process = subprocess.Popen([sys.executable, "-c", BOOTSTRAP, SCRIPT] + args,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    imports = []
+    for line in err.splitlines():
+        if line.startswith("import time: "):
+            us, depth, name = line[len("import time: "):].split("|")
+            imports.append((int(us), int(depth), name))
+    return imports
+
+
+def main():
+    args = sys.argv[1:] or ["-l"]
+    print "Arguments: %s" % " ".join(args)
+
+    imports = measure_imports(args)
+    print "%10s | module" % "cumul (us)"
+    for us, depth, name in imports:
+        print "%10d | %s%s" % (us, "  " * depth, name)
+
+    loaded = set(x[2] for x in imports)
+    heavy = [x for x in HEAVY_MODULES if x in loaded]
+    print "Heavy modules loaded: %s" % (", ".join(heavy) if heavy else "none")
+    print "Total import time: %.3fs" % (sum(x[0] for x in imports if x[1] == 0) / 1e6)
+    print "Median wall time over %d runs: %.3fs" % (RUN_COUNT, measure_wall_time(args))
+
+    if any(x in LIGHT_ARGS for x in args):
+        loaded_build_modules = [x for x in BUILD_MODULES if x in loaded]
+        if loaded_build_modules:
+            print "FAIL: %s loaded build modules: %s" % (" ".join(args), ", ".join(loaded_build_modules))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())